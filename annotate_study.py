@@ -1,4 +1,4 @@
-import csv, sys, argparse, sqlite3, os
+import csv, sys, argparse, os, io, multiprocessing, collections
 import admonitions, fst_dropoutrate
 
 __version__ = (0, 0, 1)
@@ -6,57 +6,148 @@ __version__ = (0, 0, 1)
 parser = argparse.ArgumentParser(description='Copies FSTs dropout rates into a CSV file')
 
 parser.add_argument('file', help='CSV file to generate')
-parser.add_argument('--db', help='Database to use (defaults to fst_dropout_rates.sqlite) in the directory of this script')
+parser.add_argument('--db', help='Database (or table compiled by fst_dropoutrate.py --compile) to use (defaults to fst_dropout_rates.sqlite) in the directory of this script')
 parser.add_argument('--table', default='fst_dropout_rates', help='Table to use in database')
 parser.add_argument('-k', '--kit', default='Identifiler', help='Kit used in validation study')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='Annotate chunks of rows in this many worker processes at once (default 1); output is the same as without')
+parser.add_argument('--chunk', type=int, default=5000, help='Rows in each chunk given to a worker with --jobs (default 5000)')
 
 args = parser.parse_args()
 
 if args.db is None:
     args.db = os.path.join(os.path.dirname(sys.argv[0]), 'fst_dropout_rates.sqlite')
 
-con = sqlite3.connect(args.db)
-cur = con.cursor()
-out = None
+def alias_index(locii):
+    '''{name: locus} for every name that is a prefix of some locus in (sorted) locii.
+
+    A name resolves by walking locii in order, moving to each locus that
+    starts with where it has got to so far; only prefixes ever match, so
+    they're all the names that need an entry.
+    '''
+    aliases = {}
+    for k in locii:
+        for n in range(len(k) + 1):
+            p = k[:n]
+            if p in aliases:
+                continue
+            loc = p
+            for k2 in locii:
+                if k2.startswith(loc):
+                    loc = k2
+            aliases[p] = loc
+    return aliases
+
+def annotate(i, row):
+    '''The i'th row of the study (a dict, as from csv.DictReader) with the rates of its locus in its case added.'''
+    rates = casecache[int(row['Case Name'])]
+    name = row['Locus']
+    # A name that had to be resolved once stays resolved from then on, even in cases that have it as it is
+    loc = aliases[name] if resolved.get(name, i + 1) <= i else name
+
+    new = row.copy()
+    for t in types:
+        rate = rates.get(loc, {}).get(t)
+        new[t] = str(rate) if rate is not None else 'ERROR'
+    return new
+
+def chunks(f, size, stop=None):
+    '''(index of first row, [rows as lists]) for each run of size rows of the study before row stop, numbered as csv.DictReader would.'''
+    rdr = csv.reader(f)
+    next(rdr, None)
+    start, rows = 0, []
+    for values in rdr:
+        if values == []:
+            continue  # csv.DictReader skips these, too
+        if start + len(rows) == stop:
+            break
+        rows.append(values)
+        if len(rows) == size:
+            yield start, rows
+            start, rows = start + size, []
+    if rows:
+        yield start, rows
+
+def annotate_chunk(chunk):
+    '''CSV text of a chunk of annotated rows, in a worker forked once the rates were all known.'''
+    start, rows = chunk
+    buf = io.StringIO()
+    wr = csv.DictWriter(buf, fieldnames + types)
+    for i, values in enumerate(rows, start):
+        # As csv.DictReader makes them
+        row = dict(zip(fieldnames, values))
+        if len(values) > len(fieldnames):
+            row[None] = values[len(fieldnames):]
+        for key in fieldnames[len(values):]:
+            row[key] = None
+        wr.writerow(annotate(i, row))
+    return buf.getvalue()
+
+rtable = fst_dropoutrate.open_table(args.db, args.table)
+
+locii = sorted(rtable.loci)
+types = sorted(rtable.types)
+aliases = alias_index(locii)
+
+# Every case's rates up front, once for each distinct set of parameters (as given on the case's first row)
+params, first = {}, {}
+firstseen = {}  # (locus name, case): first row with both, for names that could need resolving
 rdr = csv.DictReader(open(args.file))
-casecache = {}
-locmap = {}
+for i, row in enumerate(rdr):
+    caseno = int(row['Case Name'])
+    if caseno not in params:
+        params[caseno] = (float(row['Quant']), int(row['Contributors']), row['D/ND'].upper() == 'D')
+        first[caseno] = i
+    if row['Locus'] in aliases:
+        firstseen.setdefault((row['Locus'], caseno), i)
+fieldnames = rdr.fieldnames
+# A case FST can't do stops the output at its first row, after the rows before it
+rates_for = {}
+stop, error = None, None
+for caseno, p in params.items():
+    if p not in rates_for:
+        quant, contributors, deducible = p
+        try:
+            rates_for[p] = fst_dropoutrate.calc_dropout(quant, args.kit, contributors, deducible, table = rtable)
+        except fst_dropoutrate.QuantityError as e:
+            stop, error = first[caseno], e
+            break
+casecache = {caseno: rates_for[p] for caseno, p in params.items() if p in rates_for}
+
+# The first row at which each locus name was missing from its case's rates, and so resolved through the aliases
+resolved = {}
+for (name, caseno), i in firstseen.items():
+    if caseno in casecache and name not in casecache[caseno] and i < resolved.get(name, i + 1):
+        resolved[name] = i
 
-cur.execute(f'SELECT DISTINCT Locus FROM {args.table}')
-locii = sorted(map(lambda x: x[0], cur.fetchall()))
-cur.execute(f'SELECT DISTINCT Dropout FROM {args.table}')
-types = sorted(map(lambda x: x[0], cur.fetchall()))
+if args.jobs > 1:
+    pool = multiprocessing.get_context('fork').Pool(args.jobs)
+    pending = collections.deque()
+    if params:
+        csv.DictWriter(sys.stdout, fieldnames + types).writeheader()
+    for chunk in chunks(open(args.file), args.chunk, stop):
+        pending.append(pool.apply_async(annotate_chunk, (chunk,)))
+        # Keep only a few chunks in flight, so a large study isn't all read in at once
+        if len(pending) > 2 * args.jobs:
+            sys.stdout.write(pending.popleft().get())
+    for res in pending:
+        sys.stdout.write(res.get())
+    pool.close()
+    pool.join()
+    if error is not None:
+        print(f'ERROR: {error}')
+        exit(2)
+    exit()
 
-for row in rdr:
+out = None
+rdr = csv.DictReader(open(args.file))
+for i, row in enumerate(rdr):
     #print(row)
 
     if out is None:
         out = csv.DictWriter(sys.stdout, rdr.fieldnames + types)
         out.writeheader()
+    if i == stop:
+        print(f'ERROR: {error}')
+        exit(2)
 
-    caseno = int(row['Case Name'])
-    if caseno not in casecache:
-        casecache[caseno] = fst_dropoutrate.calc_dropout(
-            float(row['Quant']),
-            args.kit,
-            int(row['Contributors']),
-            row['D/ND'].upper() == 'D',
-            con = con,
-        )
-        #print('New case', caseno)
-        #print(casecache[caseno])
-    rates = casecache[caseno]
-
-    loc = locmap.get(row['Locus'], row['Locus'])
-    if loc not in rates:
-        for k in locii:
-            if k.startswith(loc):
-                locmap[row['Locus']] = k
-                loc = k
-
-    new = row.copy()
-    for t in types:
-        rate = rates.get(loc, {}).get(t)
-        new[t] = str(rate) if rate is not None else 'ERROR'
-
-    out.writerow(new)
+    out.writerow(annotate(i, row))
@@ -1,4 +1,5 @@
-import sqlite3, csv, argparse, sys, os, json, ntpath, re
+import sqlite3, csv, argparse, sys, os, json
+from lrseries import map_casename, map_cont
 
 parser = argparse.ArgumentParser(description='Stand-in for a full extraction from the batch tool')
 
@@ -15,21 +16,6 @@ fo = sys.stdout
 if args.output is not None:
     fo = open(args.output, 'w')
 
-NUM_RE = re.compile(r'\d+')
-def map_casename(cn):
-    #return ntpath.splitext(ntpath.basename(cn))[0]
-    return NUM_RE.search(cn).group(0)
-
-def map_ncont_cont(co):
-    ident = ntpath.splitext(ntpath.basename(co))[0]
-    dirn = ntpath.basename(ntpath.dirname(co))
-    return f'{dirn}_{ident}'
-
-def map_cont_cont(co):
-    return ntpath.splitext(ntpath.basename(co))[0]
-
-map_cont = map_cont_cont  # TODO: make configurable
-
 cols = args.cols.split(',')
 fns = ['Case', 'Contributor'] + cols
 wr = csv.DictWriter(fo, fns)
@@ -1,18 +1,24 @@
-import argparse, sqlite3, os, sys
+import argparse, sqlite3, os, sys, csv, math, logging, threading, json, stat, socketserver, struct, mmap, hashlib, signal
 import admonitions
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 __version__ = (0, 0, 1)
 
-con = None
-args = None
+# Explanations of each step go out at DEBUG (-v/--verbose), suspect data at WARNING
+log = logging.getLogger('fst_dropoutrate')
 
-def verbose_print(*a, **k):
-    if args and args.verbose:
-        print(*a, **k)
+class DropoutError(Exception):
+    '''Base of the errors raised computing dropout rates.'''
 
-def init():
-    global con, args
+class QuantityError(DropoutError, ValueError):
+    '''A quantity FST has no rates for (below the lowest rung, or not a number).'''
 
+def init():
+    '''Parse the command line and open the database; returns (args, con).'''
     parser = argparse.ArgumentParser(description='Calculates dropout rates used by NYS OCME\'s FST')
 
     parser.add_argument('-q', '--quantity', type=float, help='Amount of DNA material in picograms (pg)')
@@ -25,92 +31,259 @@ def init():
     parser.add_argument('-V', '--version', action='store_true', help='Instead of doing anything else, print out version and regulatory information')
     parser.add_argument('-v', '--verbose', action='store_true', help='Explain the actions taken by the program in detail')
     parser.add_argument('--table', default='fst_dropout_rates', help='Table to use in database')
+    parser.add_argument('--quantities', help='Instead of -q, compute rates for each of these quantities (comma separated, or start:stop:step) as CSV')
+    parser.add_argument('--batch', help='Instead of -q/-n/-k/-d, compute rates for each row of this CSV (columns Quant, Kit, Contributors, Deducible as yes/no) as CSV')
+    parser.add_argument('-o', '--output', help='File to write --quantities/--batch CSV to (defaults to stdout)')
+    parser.add_argument('--compile', metavar='FILE', help='Instead of doing anything else, compile the table into FILE, which --db (here and in annotate_study.py) then accepts in place of the database')
+    parser.add_argument('--serve', action='store_true', help='Load the table once and answer queries on stdin/stdout (or --socket), one JSON object per line: {"quant", "kit", "contributors", "deducible"[, "no_101_round", "id"]} gets {"id", "rates"} or {"id", "error"}')
+    parser.add_argument('--socket', help='With --serve, listen on this Unix socket instead, serving each connection in its own thread')
 
     args = parser.parse_args()
+    # In --serve, stdout may be the protocol, so everything else goes to stderr
+    out = sys.stderr if args.serve else sys.stdout
+    logging.basicConfig(format='%(message)s', stream=out, level=logging.DEBUG if args.verbose else logging.WARNING)
 
     if args.version:
         print('FST Dropout Rate Tool version', '.'.join(map(str, __version__)))
         print(admonitions.LICENSE)
 
-    print(admonitions.UNVERIFIED)
+    print(admonitions.UNVERIFIED, file=out)
 
     if args.version:
         exit()
 
     if args.no_101_round or args.db:
-        print(admonitions.COMPLIANCE)
+        print(admonitions.COMPLIANCE, file=out)
         if args.no_101_round:
-            print('--no-101-round: defeats a dubious measure in FST')
+            print('--no-101-round: defeats a dubious measure in FST', file=out)
         if args.db:
-            print('--db: potentially nonstandard DB specified')
-        print()
+            print('--db: potentially nonstandard DB specified', file=out)
+        print(file=out)
 
     if args.db is None:
         args.db = os.path.join(os.path.dirname(sys.argv[0]), 'fst_dropout_rates.sqlite')
 
-    con = sqlite3.connect(args.db)
+    con = sqlite3.connect(args.db) if not is_compiled(args.db) else None
+
+    if args.compile:
+        if con is None:
+            print(f'{args.db} is already compiled')
+            exit(1)
+        compile_table(con, args.table, args.compile)
+        exit()
 
     if args.kits:
-        for row in con.execute(f'SELECT DISTINCT LabKitID, LabKit FROM {args.table}'):
+        if con is None:
+            kits = CompiledRateTable(args.db).kit_names
+        else:
+            kits = con.execute(f'SELECT DISTINCT LabKitID, LabKit FROM {args.table}')
+        for row in kits:
             print(f'Kit "{row[1]}" ID {row[0]}')
         exit()
 
-    if args.quantity is None or args.number is None or args.kit is None:
-        print('Need all of -q/--quantity, -n/--number, -k/--kit')
+    if not args.serve and args.batch is None and ((args.quantity is None and args.quantities is None) or args.number is None or args.kit is None):
+        print('Need all of -q/--quantity (or --quantities), -n/--number, -k/--kit, or else --batch')
         exit(1)
 
+    return args, con
+
+# SQLite's lower(), which only folds ASCII
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+class DropoutRateTable:
+    '''A dropout rate table read once and indexed in memory, for many calc_dropout() calls.
+
+    Rows are kept in table order under (kit, persons, deducible, quant), once
+    for each of LabKitID and LabKit, so a lookup gets the same rows as the
+    query in calc_dropout(). Keys compare as SQLite compares untyped columns
+    (like those csvtosqlite.py makes): different types are never equal.
+    '''
+    def __init__(self, con, tbl='fst_dropout_rates'):
+        self.index = {}
+        self.loci, self.types = set(), set()
+        for lkid, lk, persons, ded, quant, lc, typename, rate in con.execute(f'SELECT LabKitID, LabKit, NoOfPersonsInvolvd, Deducible, Quant, Locus, Dropout, DropOutRate FROM {tbl} ORDER BY rowid'):
+            self.loci.add(lc)
+            self.types.add(typename)
+            ded = ded.translate(ASCII_LOWER) if isinstance(ded, str) else None
+            for kit in {lkid, lk}:
+                self.index.setdefault((kit, persons, ded, quant), []).append((lc, typename, rate))
+
+    def rows(self, kit, number, deducible, quant):
+        '''(Locus, Dropout, DropOutRate) rows for a kit (name or ID), as the calc_dropout() query returns them.'''
+        return list(self.index.get((kit, str(number), 'yes' if deducible else 'no', quant), ()))
+
+# Compiled tables (--compile): a header, then JSON dictionaries of the key values, then a dense array of
+# native doubles over kit x persons x deducible x quant x locus x type, NaN where the table has no rate
+COMPILED_MAGIC = b'FSTRATES'
+COMPILED_VERSION = 1
+COMPILED_HEADER = struct.Struct('<8sII32s')  # Magic, version, dictionary length, SHA-256 of everything after the header
+DEDUCIBLE = ('yes', 'no')
+
+def is_compiled(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(COMPILED_MAGIC)) == COMPILED_MAGIC
+    except OSError:
+        return False
+
+def compile_table(con, tbl, path, logger=log):
+    '''Write table tbl of con to path as a compiled table for CompiledRateTable.
+
+    Each distinct LabKitID or LabKit value gets a kit slot, shared by values
+    matching the same rows. As with the query, the last of any duplicate
+    rows wins; they're warned about here, once.
+    '''
+    rows = con.execute(f'SELECT rowid, LabKitID, LabKit, NoOfPersonsInvolvd, Deducible, Quant, Locus, Dropout, DropOutRate FROM {tbl} ORDER BY rowid').fetchall()
+    def ordinals(values):
+        return {v: i for i, v in enumerate(dict.fromkeys(values))}
+    kitrows = {}
+    for row in rows:
+        for kit in {row[1], row[2]}:
+            kitrows.setdefault(kit, []).append(row[0])
+    slots = ordinals(tuple(rids) for rids in kitrows.values())
+    kits = {kit: slots[tuple(rids)] for kit, rids in kitrows.items()}
+    persons, quants = ordinals(row[3] for row in rows), ordinals(row[5] for row in rows)
+    loci, types = ordinals(row[6] for row in rows), ordinals(row[7] for row in rows)
+    shape = (len(slots), len(persons), len(DEDUCIBLE), len(quants), len(loci), len(types))
+
+    rates = [math.nan] * math.prod(shape)
+    for rid, lkid, lk, person, ded, quant, lc, typename, rate in rows:
+        ded = ded.translate(ASCII_LOWER) if isinstance(ded, str) else None
+        if ded not in DEDUCIBLE:
+            continue  # Never matched by a lookup
+        for slot in {kits[lkid], kits[lk]}:
+            i = ((((slot * shape[1] + persons[person]) * shape[2] + DEDUCIBLE.index(ded)) * shape[3] + quants[quant]) * shape[4] + loci[lc]) * shape[5] + types[typename]
+            if rates[i] == rates[i]:
+                logger.warning('WARNING: duplicate entryat %s/%s, overwriting %s with %s', lc, typename, rates[i], rate)
+            rates[i] = float(rate)
+
+    dictionaries = json.dumps({
+        'table': tbl, 'rows': len(rows), 'byteorder': sys.byteorder, 'shape': shape,
+        'kits': list(kits.items()), 'kit_names': list(dict.fromkeys((row[1], row[2]) for row in rows)),
+        'persons': list(persons), 'quants': list(quants), 'loci': list(loci), 'types': list(types),
+    }).encode()
+    dictionaries += b' ' * (-(COMPILED_HEADER.size + len(dictionaries)) % 8)  # Align the rates
+    body = dictionaries + struct.pack(f'={len(rates)}d', *rates)
+    with open(path, 'wb') as f:
+        f.write(COMPILED_HEADER.pack(COMPILED_MAGIC, COMPILED_VERSION, len(dictionaries), hashlib.sha256(body).digest()))
+        f.write(body)
+
+class CompiledRateTable:
+    '''A table written by compile_table(), mapped into memory; a drop-in for DropoutRateTable.
+
+    The rates are used in place; only the small dictionaries are parsed.
+    '''
+    def __init__(self, path, verify=True):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, dlen, digest = COMPILED_HEADER.unpack_from(self.mm)
+        if magic != COMPILED_MAGIC:
+            raise DropoutError(f'{path} is not a compiled rate table')
+        if version != COMPILED_VERSION:
+            raise DropoutError(f'{path} is compiled table version {version}, but only version {COMPILED_VERSION} is supported; recompile it')
+        body = memoryview(self.mm)[COMPILED_HEADER.size:]
+        if verify and hashlib.sha256(body).digest() != digest:
+            raise DropoutError(f'{path} is corrupt (checksum mismatch)')
+        d = json.loads(bytes(body[:dlen]))
+        if d['byteorder'] != sys.byteorder:
+            raise DropoutError(f'{path} was compiled on a {d["byteorder"]}-endian machine; recompile it')
+        self.rates = body[dlen:].cast('d')
+        self.shape = d['shape']
+        self.kits = dict((kit, slot) for kit, slot in d['kits'])
+        self.kit_names = [tuple(p) for p in d['kit_names']]
+        self.persons = {v: i for i, v in enumerate(d['persons'])}
+        self.quants = {v: i for i, v in enumerate(d['quants'])}
+        self.loci, self.types = d['loci'], d['types']
+
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path, verify=False)
+
+    def rows(self, kit, number, deducible, quant):
+        '''(Locus, Dropout, rate) rows for a kit (name or ID), like DropoutRateTable.rows() but in locus order.'''
+        slot, person, q = self.kits.get(kit), self.persons.get(str(number)), self.quants.get(quant)
+        if slot is None or person is None or q is None:
+            return []
+        _, np_, nd, nq, nl, nt = self.shape
+        base = (((slot * np_ + person) * nd + (0 if deducible else 1)) * nq + q) * nl * nt
+        rates = self.rates[base:base + nl * nt]
+        return [(lc, tn, rates[li * nt + ti]) for li, lc in enumerate(self.loci) for ti, tn in enumerate(self.types) if rates[li * nt + ti] == rates[li * nt + ti]]
+
+def open_table(db, tbl='fst_dropout_rates'):
+    '''The CompiledRateTable in db if it's compiled, otherwise its table tbl read into a DropoutRateTable.'''
+    if is_compiled(db):
+        return CompiledRateTable(db)
+    con = sqlite3.connect(db)
+    try:
+        return DropoutRateTable(con, tbl)
+    finally:
+        con.close()
+
+RUNGS = (6.25, 12.5, 25, 50, 100, 101, 150, 250, 500)
+
+def to_rate(rung):
+    if rung == int(rung):
+        return f'{int(rung)} pg'
+    return f'{rung} pg'
+
 # These variable names more or less match the source code from FST; apologies for their lack of objective clarity
-def calc_dropout(quant, kit, number, deducible, no_101_round=False, con=None, tbl='fst_dropout_rates'):
+def calc_dropout(quant, kit, number, deducible, no_101_round=False, con=None, tbl='fst_dropout_rates', table=None, logger=log):
+    '''Dropout rates {locus: {type: rate}} at quant, from the database con or else a preloaded DropoutRateTable.
+
+    Uses no globals, so it's safe from any thread given a connection of that
+    thread's own (or a table). Raises QuantityError for a quantity below the
+    lowest rung; logger gets the explanations and warnings.
+    '''
     if quant > 500:
-        verbose_print('quantity capped to 500pg')
+        logger.debug('quantity capped to 500pg')
         quant = 500
 
     if 100 < quant < 101:
         if no_101_round:
-            verbose_print(f'dropout would have been rounded to 101, but remains at {dropout} because you asked (--no-101-round)')
+            logger.debug('dropout would have been rounded to 101, but remains at %s because you asked (--no-101-round)', quant)
         else:
-            verbose_print('dropout rounded to 101')
+            logger.debug('dropout rounded to 101')
             quant = 101
 
-    rungs = (6.25, 12.5, 25, 50, 100, 101, 150, 250, 500)
+    rungs = RUNGS
     if quant in rungs:
-        verbose_print(f'quantity is a standard value in {rungs}')
+        logger.debug('quantity is a standard value in %s', rungs)
         runglow = quant
         runghigh = quant
     else:
         # Find the interval into which the rate fits
-        if quant < rungs[0]:
-            print(f'ERROR: quantity {quant} is less than the lowest rung {rungs[0]}; FST would fail in this instance.')
-            exit(2)
+        if not quant >= rungs[0]:
+            raise QuantityError(f'quantity {quant} is less than the lowest rung {rungs[0]}; FST would fail in this instance.')
 
         for ridx, rung in enumerate(rungs[:-1]):
             if quant > rung and quant < rungs[ridx + 1]:
-                verbose_print(f'selected rate interval {rung}, {rungs[ridx + 1]}')
+                logger.debug('selected rate interval %s, %s', rung, rungs[ridx + 1])
                 runglow = rung
                 runghigh = rungs[ridx + 1]
 
-    def to_rate(rung):
-        if rung == int(rung):
-            return f'{int(rung)} pg'
-        return f'{rung} pg'
-
     ratelow, ratehigh = to_rate(runglow), to_rate(runghigh)
 
-    verbose_print(f'selected rates are {ratelow}, {ratehigh}')
+    logger.debug('selected rates are %s, %s', ratelow, ratehigh)
 
-    cur = con.cursor()
+    cur = con.cursor() if table is None else None
 
     def get_rates(r):
-        cur.execute(f'SELECT Locus, Dropout, DropOutRate FROM {tbl} WHERE (LabKitID=? OR LabKit=?) AND NoOfPersonsInvolvd=? AND lower(Deducible)=? AND Quant=?', (kit, kit, str(number), 'yes' if deducible else 'no', r))
+        if table is not None:
+            rows = table.rows(kit, number, deducible, r)
+        else:
+            cur.execute(f'SELECT Locus, Dropout, DropOutRate FROM {tbl} WHERE (LabKitID=? OR LabKit=?) AND NoOfPersonsInvolvd=? AND lower(Deducible)=? AND Quant=?', (kit, kit, str(number), 'yes' if deducible else 'no', r))
+            rows = cur.fetchall()
         rates = {}
-        rows = cur.fetchall()
-        verbose_print(f'rows queried: {rows}')
+        logger.debug('rows queried: %s', rows)
         for row in rows:
             lc, typename, rate = row
             if lc not in rates:
                 rates[lc] = {}
             if typename in rates[lc]:
-                print(f'WARNING: duplicate entryat {lc}/{typename}, overwriting {rates[lc][typename]} with {rate}')
+                logger.warning('WARNING: duplicate entryat %s/%s, overwriting %s with %s', lc, typename, rates[lc][typename], rate)
             rates[lc][typename] = float(rate)
         return rates
 
@@ -129,9 +302,204 @@ def calc_dropout(quant, kit, number, deducible, no_101_round=False, con=None, tb
 
     return orates
 
+def calc_dropouts(quants, kit, number, deducible, no_101_round=False, con=None, tbl='fst_dropout_rates', table=None, logger=log):
+    '''calc_dropout() over an array of quantities at once; returns ([(locus, type)], rates array of len(quants) rows).
+
+    Each row holds exactly what calc_dropout() gives for that quantity, with
+    NaN where it would have no entry (or fail for want of one at the upper
+    rung). Needs numpy.
+    '''
+    if np is None:
+        raise RuntimeError('batch dropout rates need numpy')
+    if table is None:
+        table = DropoutRateTable(con, tbl)
+    q = np.array(quants, dtype=np.float64)
+    q[q > 500] = 500
+    if not no_101_round:
+        q[(100 < q) & (q < 101)] = 101
+    low = ~(q >= RUNGS[0])  # Catches NaN, too
+    if low.any():
+        raise QuantityError(f'quantity {q[low][0]} is less than the lowest rung {RUNGS[0]}; FST would fail in this instance.')
+
+    # Every rung's rates as a row of one matrix, over every (locus, type) seen at any of them
+    cols, colidx = [], {}
+    per_rung = []
+    for rung in RUNGS:
+        rr = {}
+        for lc, typename, rate in table.rows(kit, number, deducible, to_rate(rung)):
+            if (lc, typename) in rr:
+                logger.warning('WARNING: duplicate entryat %s/%s, overwriting %s with %s', lc, typename, rr[lc, typename], rate)
+            rr[lc, typename] = float(rate)
+            if (lc, typename) not in colidx:
+                colidx[lc, typename] = len(cols)
+                cols.append((lc, typename))
+        per_rung.append(rr)
+    rates = np.full((len(RUNGS), len(cols)), math.nan)
+    for ridx, rr in enumerate(per_rung):
+        for key, rate in rr.items():
+            rates[ridx, colidx[key]] = rate
+
+    rungs = np.array(RUNGS)
+    hi = np.searchsorted(rungs, q)  # First rung >= q
+    exact = rungs[hi] == q
+    lo = np.where(exact, hi, hi - 1)
+    # The same arithmetic as calc_dropout(), so results are identical; exact rungs are taken as they are
+    frac = (q - rungs[lo]) / np.where(exact, 1, rungs[hi] - rungs[lo])
+    lrates, hrates = rates[lo], rates[hi]
+    out = np.where(exact[:, None], lrates, lrates + (hrates - lrates) * frac[:, None])
+    return cols, out
+
+class DropoutRates:
+    '''Dropout rates from one table of a database, for sharing between threads (or pickling to processes).
+
+    With preload (the default) the table is read once into a
+    DropoutRateTable, and lookups never touch the database again; otherwise
+    every thread queries through a connection of its own. A compiled db is
+    always used as it is.
+    '''
+    def __init__(self, db, tbl='fst_dropout_rates', preload=True, logger=log):
+        self.db, self.tbl, self.logger = db, tbl, logger
+        self.table = None
+        if preload or is_compiled(db):
+            self.table = open_table(db, tbl)
+        self.local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def connection(self):
+        '''This thread's connection to the database.'''
+        if not hasattr(self.local, 'con'):
+            self.local.con = sqlite3.connect(self.db)
+        return self.local.con
+
+    def rates(self, quant, kit, number, deducible, no_101_round=False):
+        '''As calc_dropout().'''
+        if self.table is not None:
+            return calc_dropout(quant, kit, number, deducible, no_101_round, table=self.table, logger=self.logger)
+        return calc_dropout(quant, kit, number, deducible, no_101_round, self.connection(), self.tbl, logger=self.logger)
+
+    def batch(self, quants, kit, number, deducible, no_101_round=False):
+        '''As calc_dropouts().'''
+        table = self.table if self.table is not None else DropoutRateTable(self.connection(), self.tbl)
+        return calc_dropouts(quants, kit, number, deducible, no_101_round, table=table, logger=self.logger)
+
+def is_deducible(v):
+    return v.strip().lower() in ('yes', 'y', 'true', '1', 'd')
+
+def write_batch(args):
+    '''--quantities/--batch: write rates for many quantities as CSV, one locus/type per column.'''
+    if np is None:
+        print('ERROR: --quantities and --batch need numpy')
+        exit(1)
+    table = open_table(args.db, args.table)
+    if args.batch is not None:
+        rows = list(csv.DictReader(open(args.batch, newline='')))
+        cases = [(float(row['Quant']), row['Kit'], int(row['Contributors']), is_deducible(row['Deducible'])) for row in rows]
+    else:
+        if ':' in args.quantities:
+            start, stop, step = map(float, args.quantities.split(':'))
+            quants = np.arange(start, stop, step).tolist()
+        else:
+            quants = [float(q) for q in args.quantities.split(',')]
+        cases = [(quant, args.kit, args.number, args.deducible) for quant in quants]
+
+    # One vectorized call for each (kit, persons, deducible) group of cases
+    groups = {}
+    for i, (quant, kit, number, deducible) in enumerate(cases):
+        groups.setdefault((kit, number, deducible), []).append(i)
+    results = [None] * len(cases)
+    allcols = set()
+    for (kit, number, deducible), idxs in groups.items():
+        cols, out = calc_dropouts([cases[i][0] for i in idxs], kit, number, deducible, args.no_101_round, table=table)
+        allcols.update(cols)
+        for i, row in zip(idxs, out.tolist()):
+            results[i] = dict(zip(cols, row))
+
+    allcols = sorted(allcols)
+    fo = open(args.output, 'w', newline='') if args.output else sys.stdout
+    wr = csv.writer(fo)
+    wr.writerow(['Quant', 'Kit', 'Contributors', 'Deducible'] + [f'{lc}/{tn}' for lc, tn in allcols])
+    for (quant, kit, number, deducible), res in zip(cases, results):
+        vals = [res.get(col, math.nan) for col in allcols]
+        wr.writerow([quant, kit, number, 'yes' if deducible else 'no'] + ['' if v != v else v for v in vals])
+
+def answer(rates, line, no_101_round=False):
+    '''The JSON response line to one --serve query line.
+
+    A query is an object with quant, kit, contributors and deducible (and
+    optionally no_101_round and an id to echo); the response has the id and
+    either rates, as from calc_dropout(), or an error.
+    '''
+    qid = None
+    try:
+        query = json.loads(line)
+        qid = query.get('id')
+        ded = query['deducible']
+        orates = rates.rates(
+            float(query['quant']), query['kit'], int(query['contributors']), is_deducible(ded) if isinstance(ded, str) else bool(ded),
+            bool(query.get('no_101_round', no_101_round)),
+        )
+        resp = {'id': qid, 'rates': orates}
+    except (DropoutError, ValueError, KeyError, TypeError, AttributeError) as e:
+        resp = {'id': qid, 'error': f'{type(e).__name__}: {e}'}
+    return json.dumps(resp) + '\n'
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                self.wfile.write(answer(self.server.rates, line, self.server.no_101_round).encode())
+
+class QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def serve(args):
+    '''--serve: answer queries from memory until EOF (or forever, on --socket).'''
+    rates = DropoutRates(args.db, args.table)
+    print(f'Serving {args.table} from {args.db}', file=sys.stderr)
+    if args.socket is None:
+        for line in sys.stdin:
+            if line.strip():
+                sys.stdout.write(answer(rates, line, args.no_101_round))
+                sys.stdout.flush()
+        return
+    # Only ever replace a stale socket, never some other file
+    if os.path.exists(args.socket) and stat.S_ISSOCK(os.stat(args.socket).st_mode):
+        os.unlink(args.socket)
+    with QueryServer(args.socket, QueryHandler) as server:
+        server.rates, server.no_101_round = rates, args.no_101_round
+        # A service manager stops us with SIGTERM; leave the same way as on ^C, removing the socket
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(args.socket)
+
 if __name__ == '__main__':
-    init()
-    orates = calc_dropout(args.quantity, args.kit, args.number, args.deducible, args.no_101_round, con, args.table)
+    args, con = init()
+    if args.serve:
+        serve(args)
+        exit()
+    try:
+        if args.batch is not None or args.quantities is not None:
+            write_batch(args)
+            exit()
+        if con is None:
+            orates = calc_dropout(args.quantity, args.kit, args.number, args.deducible, args.no_101_round, table=CompiledRateTable(args.db))
+        else:
+            orates = calc_dropout(args.quantity, args.kit, args.number, args.deducible, args.no_101_round, con, args.table)
+    except QuantityError as e:
+        print(f'ERROR: {e}')
+        exit(2)
 
     print('Results:')
     for lc in sorted(orates.keys()):
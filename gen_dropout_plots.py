@@ -1,5 +1,7 @@
-import argparse, sqlite3, os, sys, colorsys
+import argparse, sqlite3, os, sys, colorsys, math
+from array import array
 import admonitions
+from gpbinary import BINARY
 
 __version__ = (0, 0, 1)
 
@@ -15,6 +17,8 @@ parser.add_argument('--no-101-round', action='store_true', help="Don't emulate F
 parser.add_argument('--gp-filled-circle', type=int, default=7, help='Point style for a filled point')
 parser.add_argument('--gp-circle', type=int, default=6, help='Point style for a (non-filled) point')
 parser.add_argument('--exten', default='ps', help='Output graphic file extension')
+parser.add_argument('--binary', action='store_true', help='Write each case as packed values (.bin) instead of text (.data)')
+parser.add_argument('--binary-type', default='float64', choices=sorted(BINARY), help='Value type for --binary (default float64)')
 parser.add_argument('--terminal', default='postscript color', help='GNUPlot terminal to use (with options)')
 
 args = parser.parse_args()
@@ -142,8 +146,13 @@ for cid, case in enumerate(cases):
     deduc = deduc.lower() == 'yes'
     print(f'Case {cid}/{len(cases)}: kit {lk} type {typename} no {npers} deduc {deduc}: ', end='')
 
-    fn = f'{args.output}c{cid}.data'
-    df = open(fn, 'w')
+    if args.binary:
+        fn = f'{args.output}c{cid}.bin'
+        df = open(fn, 'wb')
+        code, fmt = BINARY[args.binary_type]
+    else:
+        fn = f'{args.output}c{cid}.data'
+        df = open(fn, 'w')
 
     plots = []
     i = 0
@@ -164,7 +173,7 @@ for cid, case in enumerate(cases):
             dprs[rung] = float(rows[0][0])
             xvs.append(rung)
 
-        df.write(f'# {lc} lines\n')
+        segs = []
         for lrung, hrung in zip(xvs[:-1], xvs[1:]):
             ldr, hdr = dprs[lrung], dprs[hrung]
             if lrung == 100 and not args.no_101_round:
@@ -173,22 +182,34 @@ for cid, case in enumerate(cases):
             else:
                 x1, y1 = float(lrung), ldr
                 x2, y2 = float(hrung), interp(x1, y1, float(hrung), hdr)
-            df.write(f'{x1}\t{y1}\n{x2}\t{y2}\n\n')
-        df.write('\n')
-        plots.append(f'"{fn}" index {i} with lines title "{lc}" lc rgb "{colors[i//2]}"')
+            segs.append((x1, y1, x2, y2))
+
+        if args.binary:
+            # No blank lines between records, so an undefined (NaN) point breaks the line between segments
+            lines, points = array(code), array(code)
+            for x1, y1, x2, y2 in segs:
+                lines.extend((x1, y1, x2, y2, math.nan, math.nan))
+                points.extend((x1, y1, args.gp_filled_circle, x2, y2, args.gp_circle))
+            points.extend((xvs[-1], dprs[xvs[-1]], args.gp_filled_circle))
+            skip = df.tell()
+            df.write(lines.tobytes())
+            lsrc = f'"{fn}" binary skip={skip} record={len(lines) // 2} format="{fmt * 2}"'
+            skip = df.tell()
+            df.write(points.tobytes())
+            psrc = f'"{fn}" binary skip={skip} record={len(points) // 3} format="{fmt * 3}"'
+        else:
+            df.write(f'# {lc} lines\n')
+            for x1, y1, x2, y2 in segs:
+                df.write(f'{x1}\t{y1}\n{x2}\t{y2}\n\n')
+            df.write('\n')
+            df.write(f'# {lc} points\n')
+            for x1, y1, x2, y2 in segs:
+                df.write(f'{x1}\t{y1}\t{args.gp_filled_circle}\n{x2}\t{y2}\t{args.gp_circle}\n')
+            df.write(f'{xvs[-1]}\t{dprs[xvs[-1]]}\t{args.gp_filled_circle}\n\n\n')
+            lsrc, psrc = f'"{fn}" index {i}', f'"{fn}" index {i + 1}'
+        plots.append(f'{lsrc} with lines title "{lc}" lc rgb "{colors[i//2]}"')
         i += 1
-        df.write(f'# {lc} points\n')
-        for lrung, hrung in zip(xvs[:-1], xvs[1:]):
-            ldr, hdr = dprs[lrung], dprs[hrung]
-            if lrung == 100 and not args.no_101_round:
-                #print('[activated 101 round] ', end='')
-                x1, x2, y1, y2 = float(hrung), float(hrung), hdr, hdr
-            else:
-                x1, y1 = float(lrung), ldr
-                x2, y2 = float(hrung), interp(x1, y1, float(hrung), hdr)
-            df.write(f'{x1}\t{y1}\t{args.gp_filled_circle}\n{x2}\t{y2}\t{args.gp_circle}\n')
-        df.write(f'{xvs[-1]}\t{dprs[xvs[-1]]}\t{args.gp_filled_circle}\n\n\n')
-        plots.append(f'"{fn}" index {i} with dots notitle lc rgb "{colors[i//2]}" lw 5')
+        plots.append(f'{psrc} with dots notitle lc rgb "{colors[i//2]}" lw 5')
         i += 1
 
     print('Done!')
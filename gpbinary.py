@@ -0,0 +1,5 @@
+# --binary types, shared by the scripts writing gnuplot binary data: (array typecode, gnuplot binary format)
+BINARY = {
+    'float32': ('f', '%float32'),
+    'float64': ('d', '%float64'),
+}
@@ -0,0 +1,89 @@
+import time, json, sys
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def peak_rss():
+    '''Peak resident set size of this process (or any finished child) so far, in KiB; None where unknown.'''
+    if resource is None:
+        return None
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+class Profile:
+    '''Wall and CPU time, rows and SQLite statements of each phase of a run, for --profile.
+
+    CPU time is this process's own, so work done in worker processes only
+    shows up as the wall time spent waiting for it.
+    '''
+    def __init__(self):
+        self.records = []
+        self.statements = 0
+        self.start = time.perf_counter(), time.process_time()
+
+    def count(self, stmt):
+        '''Trace callback for a store, counting the statements it runs.'''
+        self.statements += 1
+
+    def phase(self, name, series=None):
+        return Phase(self, name, series)
+
+    def reading(self, batches, outer):
+        '''Pass raw batches through, moving the time spent producing them out of outer into a "read" record of their own.'''
+        rec = {'phase': 'read', 'series': outer['series'], 'wall': 0.0, 'cpu': 0.0, 'rows': 0, 'statements': 0}
+        it = iter(batches)
+        while True:
+            w, c = time.perf_counter(), time.process_time()
+            batch = next(it, None)
+            dw, dc = time.perf_counter() - w, time.process_time() - c
+            rec['wall'] += dw
+            rec['cpu'] += dc
+            outer['wall'] -= dw
+            outer['cpu'] -= dc
+            if batch is None:
+                break
+            rec['rows'] += len(batch[1])
+            yield batch
+        rec['peak_rss'] = peak_rss()
+        self.records.append(rec)
+
+    def finish(self):
+        '''Add a "total" record covering everything since the profile was made.'''
+        rows = sum(rec['rows'] for rec in self.records if rec['phase'] == 'ingest')
+        self.records.append({
+            'phase': 'total', 'series': None,
+            'wall': time.perf_counter() - self.start[0], 'cpu': time.process_time() - self.start[1],
+            'rows': rows, 'statements': sum(rec['statements'] for rec in self.records), 'peak_rss': peak_rss(),
+        })
+
+    def table(self, f=sys.stderr):
+        print(f'{"phase":<8} {"series":<40} {"wall s":>9} {"cpu s":>9} {"rows":>10} {"rows/s":>11} {"stmts":>8} {"peak MiB":>9}', file=f)
+        for rec in self.records:
+            rate = f'{rec["rows"] / rec["wall"]:.0f}' if rec['rows'] and rec['wall'] > 0 else '-'
+            rss = f'{rec["peak_rss"] / 1024:.1f}' if rec['peak_rss'] is not None else '-'
+            series = rec['series'] or ''
+            if len(series) > 40:
+                series = '...' + series[-37:]
+            print(f'{rec["phase"]:<8} {series:<40} {rec["wall"]:>9.3f} {rec["cpu"]:>9.3f} {rec["rows"]:>10} {rate:>11} {rec["statements"]:>8} {rss:>9}', file=f)
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.records, f, indent=1)
+
+class Phase:
+    '''Times the body of a with block into a record, which it yields so rows can be filled in.'''
+    def __init__(self, prof, name, series):
+        self.prof = prof
+        self.rec = {'phase': name, 'series': series, 'wall': 0.0, 'cpu': 0.0, 'rows': 0, 'statements': 0}
+
+    def __enter__(self):
+        self.wall, self.cpu, self.statements = time.perf_counter(), time.process_time(), self.prof.statements
+        return self.rec
+
+    def __exit__(self, *exc):
+        self.rec['wall'] += time.perf_counter() - self.wall
+        self.rec['cpu'] += time.process_time() - self.cpu
+        self.rec['statements'] = self.prof.statements - self.statements
+        self.rec['peak_rss'] = peak_rss()
+        self.prof.records.append(self.rec)
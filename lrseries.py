@@ -0,0 +1,353 @@
+import csv, math, os, json, sqlite3, heapq, operator, ntpath, re, multiprocessing
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+AGGS = {
+    'min': min,
+    'max': max,
+}
+MAPS = {
+    'id': lambda x: x,
+    'log10': math.log10,
+}
+# Vectorized AGGS over the rows of an array, and where each of MAPS is defined if not everywhere
+NP_AGGS = {
+    'min': lambda a: a.min(axis=1),
+    'max': lambda a: a.max(axis=1),
+}
+MAP_DOMAINS = {
+    'log10': lambda v: v > 0,
+}
+# MAPS for values that are already log10 LRs, as batch tool databases store them
+LOG10_MAPS = {
+    'id': lambda x: 10.0 ** x,
+    'log10': lambda x: x,
+}
+
+BATCH = 10000  # Rows per raw batch yielded by read_series
+
+def parse_spec(sdesc):
+    '''Split a -s/--series spec into (filename, [(column, op, value)], title or None); see --help-series.'''
+    parts = sdesc.split(':')
+    conds = []
+    if len(parts) >= 2 and parts[1]:
+        for part in parts[1].split(','):
+            if '=' in part:
+                col, _, val = part.partition('=')
+                conds.append((col, '==', val))
+            elif '^' in part:
+                col, _, val = part.partition('^')
+                conds.append((col, 'startswith', val))
+            elif '$' in part:
+                col, _, val = part.partition('$')
+                conds.append((col, 'endswith', val))
+            else:
+                raise ValueError(f"Couldn't interpret condition {part} of series {sdesc}")
+    title = parts[2] if len(parts) >= 3 and parts[2] else None
+    return parts[0], conds, title
+
+# Python expressions for each condition op, over a row cell and a value
+CONDS = {
+    '==': '{cell} == {val}',
+    'startswith': '{cell}.startswith({val})',
+    'endswith': '{cell}.endswith({val})',
+}
+
+def columns(header, names, sdesc):
+    '''Positions of names in a csv header (the last of any repeated name, as with csv.DictReader).'''
+    pos = {name: i for i, name in enumerate(header)}
+    try:
+        return [pos[name] for name in names]
+    except KeyError as e:
+        raise ValueError(f'Series {sdesc} has no column {e.args[0]}')
+
+def compile_filter(conds, header, sdesc):
+    '''Compile [(column, op, value)] into one predicate over csv.reader rows with this header.'''
+    if not conds:
+        return lambda row: True
+    env = {}
+    tests = []
+    for i, ((col, op, val), pos) in enumerate(zip(conds, columns(header, [c[0] for c in conds], sdesc))):
+        env[f'v{i}'] = val
+        tests.append(CONDS[op].format(cell=f'row[{pos}]', val=f'v{i}'))
+    return eval(f'lambda row: {" and ".join(tests)}', env)
+
+def getter(positions):
+    '''Like operator.itemgetter, but always returning a tuple.'''
+    if len(positions) == 1:
+        i, = positions
+        return lambda row: (row[i],)
+    if not positions:
+        return lambda row: ()
+    return operator.itemgetter(*positions)
+
+def to_float(s):
+    try:
+        return float(s)
+    except ValueError:
+        return math.nan
+
+# Batch tool databases: keys are derived from the evidence and profile paths
+NUM_RE = re.compile(r'\d+')
+def map_casename(cn):
+    #return ntpath.splitext(ntpath.basename(cn))[0]
+    return NUM_RE.search(cn).group(0)
+
+def map_ncont_cont(co):
+    ident = ntpath.splitext(ntpath.basename(co))[0]
+    dirn = ntpath.basename(ntpath.dirname(co))
+    return f'{dirn}_{ident}'
+
+def map_cont_cont(co):
+    return ntpath.splitext(ntpath.basename(co))[0]
+
+map_cont = map_cont_cont  # TODO: make configurable
+
+def is_batch_db(fn):
+    '''Whether fn is a SQLite database (taken to be from the batch tool) rather than a csv.'''
+    with open(fn, 'rb') as f:
+        return f.read(16) == b'SQLite format 3\0'
+
+def odata_path(name):
+    return '$."' + name.replace('"', '\\"') + '"'
+
+def read_batch_db(sidx, sdesc, races, every=None):
+    '''Like read_series(), but from the batch_data table of a batch tool database.
+
+    Races and any other filtered columns are read from odata in SQL; Case and
+    Contributor come from map_casename and map_cont, as in batchtool_extract.py.
+    Values are the log10 LRs as stored (see LOG10_MAPS), not exponentiated.
+    '''
+    fn, conds, title = parse_spec(sdesc)
+    db = sqlite3.connect(f'file:{fn}?mode=ro', uri=True)
+    def has(name):
+        return db.execute("SELECT 1 FROM batch_data WHERE json_type(NULLIF(odata, ''), ?) IS NOT NULL LIMIT 1", (odata_path(name),)).fetchone() is not None
+    present = [r for r in races if has(r)]
+    extra = []
+    for col, op, val in conds:
+        if col not in ('Case', 'Contributor') and col not in extra and has(col):
+            extra.append(col)
+    header = ['Case', 'Contributor'] + present + extra
+    filt = compile_filter(conds, header, sdesc)
+    # Race values only if numeric (so NULL, hence NaN, otherwise), filter columns as text
+    sel = ["CASE WHEN json_type(odata, ?) IN ('real', 'integer') THEN json_extract(odata, ?) END" for r in present]
+    sel += ['CAST(json_extract(odata, ?) AS TEXT)' for col in extra]
+    params = [odata_path(r) for r in present for _ in range(2)] + [odata_path(col) for col in extra]
+    cur = db.execute(f"SELECT evidence, profile, {', '.join(sel) or 'NULL'} FROM batch_data WHERE odata IS NOT NULL AND odata != ''", params)
+    k = len(present)
+    keys, vals = [], array('d')
+    for idx, row in enumerate(cur):
+        if every is not None and idx % every == 0:
+            print(f'Series {sidx} ({sdesc}): imported {idx} so far...')
+        key = (map_casename(row[0]), map_cont(row[1]))
+        if conds and not filt(key + row[2:]):
+            continue
+        keys.append(key)
+        vals.extend(math.nan if v is None else v for v in row[2:2 + k])
+        if len(keys) >= BATCH:
+            yield present, keys, vals
+            keys, vals = [], array('d')
+    yield present, keys, vals
+
+def read_series(sidx, sdesc, races, every=None):
+    '''Read and filter one series, yielding raw batches of (races, keys, vals).
+
+    Nothing is aggregated here (see reduce_batch): races is the subset of the
+    requested races present in the file, keys a list of (cnum, contr), and
+    vals a row-major array of len(keys) * len(races) values, NaN where a value
+    didn't parse. Everything is picklable, so this can run in a worker.
+    '''
+    fn, conds, title = parse_spec(sdesc)
+    if is_batch_db(fn):
+        yield from read_batch_db(sidx, sdesc, races, every)
+        return
+    rdr = csv.reader(open(fn, newline=''))
+    header = next(rdr, None)
+    if header is None:
+        yield [], [], array('d')
+        return
+    present = [r for r in races if r in header]
+    # Everything about the header is resolved once, up front
+    filt = compile_filter(conds, header, sdesc)
+    kget = getter(columns(header, ['Case', 'Contributor'], sdesc))
+    rget = getter(columns(header, present, sdesc))
+    width = len(header)
+    keys, vals = [], array('d')
+    for idx, row in enumerate(filter(None, rdr)):  # csv.DictReader skips blank lines too
+        if every is not None and idx % every == 0:
+            print(f'Series {sidx} ({sdesc}): imported {idx} so far...')
+        if len(row) < width:
+            row += [''] * (width - len(row))
+        if not filt(row):
+            continue
+        keys.append(kget(row))
+        vals.extend(map(to_float, rget(row)))
+        if len(keys) >= BATCH:
+            yield present, keys, vals
+            keys, vals = [], array('d')
+    yield present, keys, vals
+
+def feed_series(q, *a, **k):
+    '''Put read_series() batches on q, then None (or the exception that stopped it), in a worker process.'''
+    try:
+        for batch in read_series(*a, **k):
+            q.put(batch)
+    except Exception as e:
+        q.put(e)
+        return
+    q.put(None)
+
+class ReadAhead:
+    '''Reads series in forked worker processes, streaming their batches back in the order they were added.
+
+    At most jobs series are read at once, each at most depth batches ahead
+    of whatever is consuming it, so however large the series, only a few
+    batches are ever held anywhere.
+    '''
+    def __init__(self, jobs, depth=8):
+        # Forked explicitly: scripts using this needn't have a __main__ guard
+        self.ctx = multiprocessing.get_context('fork')
+        self.jobs, self.depth = jobs, depth
+        self.reads = []  # [args, kwargs, queue, process], the last two once started
+        self.started = 0
+
+    def add(self, *a, **k):
+        '''As read_series(); series must be consumed in the order they're added.'''
+        self.reads.append([a, k, None, None])
+        return self._batches(len(self.reads) - 1)
+
+    def _start(self, upto):
+        while self.started < min(upto, len(self.reads)):
+            read = self.reads[self.started]
+            read[2] = self.ctx.Queue(self.depth)
+            read[3] = self.ctx.Process(target=feed_series, args=(read[2],) + read[0], kwargs=read[1], daemon=True)
+            read[3].start()
+            self.started += 1
+
+    def _batches(self, i):
+        self._start(i + self.jobs)
+        q, proc = self.reads[i][2:]
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+        proc.join()
+        self.reads[i][2:] = None, None
+        self._start(i + 1 + self.jobs)
+
+def reduce_batch(batch, races, agg, mapping, log10=False):
+    '''Aggregate a raw batch over races and map it; returns (keys, values, drops).
+
+    values is an array parallel to keys holding NaN for each dropped row: one
+    with a value that didn't parse, or that agg or mapping rejected. With
+    log10, the raw values are log10 LRs (agg is monotonic, so the order of
+    aggregating and mapping doesn't matter).
+    '''
+    present, keys, vals = batch
+    k = len(present)
+    cols = [i for i, r in enumerate(present) if r in races]
+    aggf, mf = AGGS[agg], (LOG10_MAPS if log10 else MAPS)[mapping]
+    values = array('d')
+    if np is not None and cols:
+        a = np.frombuffer(vals, dtype=np.float64).reshape(len(keys), k)[:, cols]
+        red = NP_AGGS[agg](a)  # NaN propagates
+        if mapping in MAP_DOMAINS and not log10:
+            red[~MAP_DOMAINS[mapping](red)] = math.nan
+        ok = ~np.isnan(red)
+        # Mapped with MAPS rather than ufuncs, which can differ in the last place
+        red[ok] = list(map(mf, red[ok].tolist()))
+        values.frombytes(red.tobytes())
+        return keys, values, len(keys) - int(np.count_nonzero(ok))
+    drops = 0
+    for i in range(len(keys)):
+        row = [vals[i * k + c] for c in cols]
+        try:
+            if any(v != v for v in row):
+                raise ValueError('unparseable value')
+            values.append(mf(aggf(row)))
+        except ValueError:
+            values.append(math.nan)
+            drops += 1
+    return keys, values, drops
+
+def select(rows, num, top):
+    '''The num highest (top) or lowest of ((cnum, contr), value) rows, in that order.
+
+    Ties go to the earliest row, as they did in the store's scan in row
+    order. Only a heap of num rows is kept while consuming rows.
+    '''
+    if top:
+        return heapq.nsmallest(num, rows, key=lambda row: -row[1])
+    return heapq.nsmallest(num, rows, key=lambda row: row[1])
+
+class DupCounter:
+    '''Counts keys seen again after their first good row, like a store's finish().
+
+    For series whose rows don't all reach the store; remembers every good key.
+    '''
+    def __init__(self):
+        self.good = set()
+        self.counts = {}
+
+    def feed(self, keys, values):
+        for key, v in zip(keys, values):
+            if key in self.good:
+                self.counts[key] = self.counts.get(key, 0) + 1
+            elif v == v:
+                self.good.add(key)
+
+    def dups(self):
+        return sorted(self.counts.items())
+
+class SeriesCache:
+    '''Raw batches from read_series() kept in a SQLite file between runs.
+
+    Entries are keyed by the file and its filter constraints, and stamped
+    with the file's size and mtime, so editing one input only invalidates
+    the series read from it. Since the batches are raw, --agg and --map can
+    change freely, and so can --races as long as no new race is asked for.
+    '''
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS raw_series (ident PRIMARY KEY, stamp, races)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS raw_batches (ident, present, cnums, contrs, vals)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS raw_batches_ident ON raw_batches (ident)')
+
+    @staticmethod
+    def key(sdesc):
+        '''Returns (ident, stamp) for a series spec.'''
+        fn, conds, title = parse_spec(sdesc)
+        st = os.stat(fn)
+        return json.dumps([os.path.abspath(fn), conds]), f'{st.st_size}:{st.st_mtime_ns}'
+
+    def get(self, ident, stamp, races):
+        '''Returns batches as from read_series() if there is a fresh entry covering races, otherwise None.'''
+        row = self.db.execute('SELECT stamp, races FROM raw_series WHERE ident=?', (ident,)).fetchone()
+        if row is None or row[0] != stamp or not set(races) <= set(json.loads(row[1])):
+            return None
+        return self._replay(ident)
+
+    def _replay(self, ident):
+        for present, cnums, contrs, blob in self.db.execute('SELECT present, cnums, contrs, vals FROM raw_batches WHERE ident=? ORDER BY rowid', (ident,)):
+            vals = array('d')
+            vals.frombytes(blob)
+            yield json.loads(present), list(zip(json.loads(cnums), json.loads(contrs))), vals
+
+    def put(self, ident, stamp, races, batches):
+        '''Pass batches through, storing them under ident once they've all been seen.'''
+        self.db.execute('DELETE FROM raw_series WHERE ident=?', (ident,))
+        self.db.execute('DELETE FROM raw_batches WHERE ident=?', (ident,))
+        for present, keys, vals in batches:
+            self.db.execute('INSERT INTO raw_batches VALUES (?, ?, ?, ?, ?)', (
+                ident, json.dumps(present), json.dumps([k[0] for k in keys]), json.dumps([k[1] for k in keys]), vals.tobytes(),
+            ))
+            yield present, keys, vals
+        self.db.execute('INSERT INTO raw_series VALUES (?, ?, ?)', (ident, stamp, json.dumps(races)))
+        self.db.commit()
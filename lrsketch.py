@@ -0,0 +1,104 @@
+import random, math, bisect
+
+def rank_error(k):
+    '''Normalized rank error of a KLL sketch of size k at 99% confidence, per the KLL analysis as fitted by Apache DataSketches.'''
+    return 2.296 / k ** 0.9723
+
+class KLL:
+    '''KLL quantile sketch: approximate ranks and quantiles of a stream in O(k) memory.
+
+    Items live in levels of compactors, an item in level h standing for 2**h
+    of the stream. A full level is sorted and every other item (from a
+    random offset) is promoted, so ranks stay unbiased; sketches of parts of
+    a stream can be merged into one of the whole. The least and greatest
+    values are kept exactly, since compaction would otherwise lose them.
+    '''
+    C = 2 / 3  # Capacity ratio between a level and the one above it
+    MIN_WIDTH = 8
+
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.n = 0
+        self.levels = [[]]
+        self.min = self.max = None
+        self.rng = random.Random(seed)  # Seeded, so plots are reproducible
+
+    def capacity(self, h):
+        return max(self.MIN_WIDTH, math.ceil(self.k * self.C ** (len(self.levels) - h - 1)))
+
+    def size(self):
+        return sum(len(level) for level in self.levels)
+
+    def max_size(self):
+        return sum(self.capacity(h) for h in range(len(self.levels)))
+
+    def update(self, values):
+        '''Add an iterable of values (NaNs are skipped).'''
+        before = len(self.levels[0])
+        self.levels[0].extend(v for v in values if v == v)
+        self.n += len(self.levels[0]) - before
+        if len(self.levels[0]) > before:
+            self.extend_range(min(self.levels[0][before:]), max(self.levels[0][before:]))
+        self.compress()
+
+    def extend_range(self, lo, hi):
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for level, items in zip(self.levels, other.levels):
+            level.extend(items)
+        self.n += other.n
+        if other.n:
+            self.extend_range(other.min, other.max)
+        self.compress()
+
+    def compress(self):
+        while self.size() >= self.max_size():
+            for h, level in enumerate(self.levels):
+                if len(level) >= self.capacity(h):
+                    if h + 1 == len(self.levels):
+                        self.levels.append([])
+                    level.sort()
+                    # An odd item out stays behind
+                    keep = [level.pop()] if len(level) % 2 else []
+                    self.levels[h + 1].extend(level[self.rng.getrandbits(1)::2])
+                    self.levels[h] = keep
+                    break
+
+    def sorted_weights(self):
+        '''([values], [cumulative weights]) of every item in the sketch, in value order.'''
+        items = sorted((v, 1 << h) for h, level in enumerate(self.levels) for v in level)
+        vals, cum, total = [], [], 0
+        for v, w in items:
+            total += w
+            vals.append(v)
+            cum.append(total)
+        return vals, cum
+
+class Summary:
+    '''Rank and quantile queries over a KLL sketch, sorting it once; the extremes are exact.'''
+    def __init__(self, sketch):
+        self.n = sketch.n
+        self.min, self.max = sketch.min, sketch.max
+        self.vals, self.cum = sketch.sorted_weights()
+
+    def quantile(self, rank):
+        '''Approximate value with rank (0-based, as an index into the sorted stream) rank.'''
+        if rank <= 0:
+            return self.min
+        if rank >= self.n - 1:
+            return self.max
+        i = bisect.bisect_right(self.cum, rank)
+        return self.vals[min(i, len(self.vals) - 1)]
+
+    def count_below(self, v):
+        '''Approximate count of values < v.'''
+        if self.n and v <= self.min:
+            return 0
+        if self.n and v > self.max:
+            return self.n
+        i = bisect.bisect_left(self.vals, v)
+        return self.cum[i - 1] if i else 0
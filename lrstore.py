@@ -0,0 +1,373 @@
+import sqlite3, itertools
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BATCH = 10000  # Rows moved at a time between a store and Python
+# Comparisons of (series 0, series N) values against 0 for each quadrant; anything else is on an axis (0)
+QUADS = {
+    1: ('>', '>'),
+    2: ('<', '>'),
+    3: ('<', '<'),
+    4: ('>', '<'),
+}
+
+class SqliteStore:
+    '''Series kept in a SQLite table; pass a file path to work out-of-core.
+
+    Series are added as keys, (cnum, contr) tuples, and parallel values; a
+    NaN value (stored as NULL) marks a row that was dropped, which is only
+    kept around until finish() for the dup check.
+    '''
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.tracer = None
+        self.db = sqlite3.connect(path)
+        cur = self.db.cursor()
+        cur.execute('DROP INDEX IF EXISTS series_key')
+        cur.execute('DROP TABLE IF EXISTS series')
+        cur.execute('CREATE TABLE series (idx, cnum, contr, value)')
+        cur.execute('CREATE INDEX series_key ON series (idx, cnum, contr)')
+
+    def add(self, sidx, keys, values):
+        self.db.executemany('INSERT INTO series VALUES (?, ?, ?, ?)', ((sidx,) + key + (v,) for key, v in zip(keys, values)))
+
+    def finish(self, sidx, check_dups=True):
+        '''Commit series sidx; returns [((cnum, contr), count)] of keys repeated after their first good row.'''
+        self.db.commit()
+        dups = []
+        if check_dups:
+            # One grouped pass instead of a lookup per row: every row after the first successfully added one is a dup
+            dups = [((cnum, contr), n) for cnum, contr, n in self.db.execute('''SELECT s.cnum, s.contr, count(*) FROM series AS s JOIN (
+                SELECT cnum, contr, min(rowid) AS first FROM series WHERE idx=? AND value IS NOT NULL GROUP BY cnum, contr
+            ) AS f USING (cnum, contr) WHERE s.idx=? AND s.rowid > f.first GROUP BY s.cnum, s.contr''', (sidx, sidx))]
+        self.db.execute('DELETE FROM series WHERE idx=? AND value IS NULL', (sidx,))
+        self.db.commit()
+        return dups
+
+    def seal(self):
+        pass
+
+    def reconnect(self):
+        '''Open a connection of our own, as in a forked process; needs a file-backed store.'''
+        self.db = sqlite3.connect(self.path)
+        self.db.set_trace_callback(self.tracer)
+
+    def trace(self, callback):
+        '''Call callback with the text of each SQL statement run from now on.'''
+        self.tracer = callback
+        self.db.set_trace_callback(callback)
+
+    def count(self, idx):
+        return self.db.execute('SELECT count(*) FROM series WHERE idx=?', (idx,)).fetchone()[0]
+
+    def _by_key(self, idx):
+        cur = self.db.execute('SELECT cnum, contr, value FROM series WHERE idx=? ORDER BY cnum, contr', (idx,))
+        return itertools.groupby(cur, key=lambda row: row[:2])
+
+    def pairs(self, idx, base=0):
+        '''Yield ([x], [y], missing, extra) chunks pairing series base (x) with series idx (y) in key order.
+
+        missing counts keys of base absent from idx, extra the reverse. A
+        duplicated key plots its first value once per occurrence in base.
+        '''
+        left, right = self._by_key(base), self._by_key(idx)
+        lk, lg = next(left, (None, None))
+        rk, rg = next(right, (None, None))
+        xs, ys, nx, ny = [], [], 0, 0
+        while lk is not None or rk is not None:
+            if rk is None or (lk is not None and lk < rk):
+                nx += 1
+                lk, lg = next(left, (None, None))
+            elif lk is None or rk < lk:
+                ny += 1
+                rk, rg = next(right, (None, None))
+            else:
+                v0s = [r[2] for r in lg]
+                v = next(rg)[2]
+                xs.extend(v0s[0] for i in v0s)
+                ys.extend(v for i in v0s)
+                lk, lg = next(left, (None, None))
+                rk, rg = next(right, (None, None))
+            if len(xs) >= BATCH:
+                yield xs, ys, nx, ny
+                xs, ys, nx, ny = [], [], 0, 0
+        yield xs, ys, nx, ny
+
+    def ordered(self, idx, comparing, base=0):
+        '''Returns (total, chunks) of the values of idx (less series base if comparing) in ascending order.'''
+        if comparing:
+            total = self.db.execute('SELECT count(*) FROM series AS s1 JOIN series AS s2 USING (cnum, contr) WHERE s1.idx = ? AND s2.idx = ?', (base, idx)).fetchone()[0]
+            cur = self.db.execute('SELECT s2.value - s1.value FROM series AS s1 JOIN series AS s2 USING (cnum, contr) WHERE s1.idx = ? AND s2.idx = ? ORDER BY (s2.value - s1.value)', (base, idx))
+        else:
+            total = self.count(idx)
+            cur = self.db.execute('SELECT value FROM series WHERE idx = ? ORDER BY value', (idx,))
+        def chunks():
+            while True:
+                rows = cur.fetchmany(BATCH)
+                if not rows:
+                    break
+                yield [r[0] for r in rows]
+        return total, chunks()
+
+    def differences(self, idx, base=0):
+        '''Yield chunks of the differences (idx less base) over the join, in no particular order.'''
+        cur = self.db.execute('SELECT s2.value - s1.value FROM series AS s1 JOIN series AS s2 USING (cnum, contr) WHERE s1.idx = ? AND s2.idx = ?', (base, idx))
+        while True:
+            rows = cur.fetchmany(BATCH)
+            if not rows:
+                break
+            yield [r[0] for r in rows]
+
+    def bounds(self, idx, comparing=False, base=0):
+        '''(min, max) of the values of idx (less series base if comparing), or (None, None) if it has none.'''
+        if comparing:
+            return self.db.execute('SELECT min(s2.value - s1.value), max(s2.value - s1.value) FROM series AS s1 JOIN series AS s2 USING (cnum, contr) WHERE s1.idx = ? AND s2.idx = ?', (base, idx)).fetchone()
+        return self.db.execute('SELECT min(value), max(value) FROM series WHERE idx=?', (idx,)).fetchone()
+
+    def histogram(self, idx, xbins, ybins=None, base=0):
+        '''Counts of idx in bins (lo, hi, n), or if ybins is given, of (base, idx) pairs over the join in xbins by ybins.
+
+        Counts come back flat, with x major; values outside lo..hi are left
+        out, and hi itself goes into the last bin.
+        '''
+        (xlo, xhi, nx), (ylo, yhi, ny) = xbins, ybins or (0, 0, 1)
+        counts = [0] * (nx * ny)
+        if ybins is None:
+            cur = self.db.execute('SELECT CAST((value - ?) / ? AS INTEGER), 0, count(*) FROM series WHERE idx=? AND value BETWEEN ? AND ? GROUP BY 1',
+                (xlo, (xhi - xlo) / nx, idx, xlo, xhi))
+        else:
+            cur = self.db.execute('''SELECT CAST((s1.value - ?) / ? AS INTEGER), CAST((s2.value - ?) / ? AS INTEGER), count(*)
+                FROM series AS s1 JOIN series AS s2 USING (cnum, contr) WHERE s1.idx=? AND s2.idx=? AND s1.value BETWEEN ? AND ? AND s2.value BETWEEN ? AND ? GROUP BY 1, 2''',
+                (xlo, (xhi - xlo) / nx, ylo, (yhi - ylo) / ny, base, idx, xlo, xhi, ylo, yhi))
+        for bx, by, n in cur:
+            counts[min(bx, nx - 1) * ny + min(by, ny - 1)] += n
+        return counts
+
+    def quadrants(self, sidx, base=0):
+        '''Yield chunks of (quadrant, cnum, contr, value in base, value in sidx) over the join, with quadrants as in QUADS.'''
+        quad = ' '.join(f'WHEN s1.value{s1o}0 AND s2.value{s2o}0 THEN {q}' for q, (s1o, s2o) in QUADS.items())
+        cur = self.db.execute(f'SELECT CASE {quad} ELSE 0 END, s1.cnum, s1.contr, s1.value, s2.value FROM series AS s1 JOIN series AS s2 USING (cnum, contr) WHERE s1.idx=? AND s2.idx=?', (base, sidx))
+        while True:
+            rows = cur.fetchmany(BATCH)
+            if not rows:
+                break
+            yield rows
+
+    def verdicts(self, sidx, pos, neg, base=0):
+        '''Yield chunks of (band in base, band in sidx, cnum, contr, value in base, value in sidx) over the join in key order.
+
+        A value's verdict band is its sign, plus one for each threshold in pos
+        (all > 0) it reaches, minus one for each in neg (all < 0) it reaches.
+        '''
+        def expr(col):
+            return ' '.join([f'({col} > 0) - ({col} < 0)'] + [f'+ ({col} >= ?)' for t in pos] + [f'- ({col} <= ?)' for t in neg])
+        cur = self.db.execute(f'''SELECT {expr('s1.value')}, {expr('s2.value')}, s1.cnum, s1.contr, s1.value, s2.value
+            FROM series AS s1 JOIN series AS s2 USING (cnum, contr) WHERE s1.idx=? AND s2.idx=? ORDER BY s1.cnum, s1.contr''',
+            (*pos, *neg, *pos, *neg, base, sidx))
+        while True:
+            rows = cur.fetchmany(BATCH)
+            if not rows:
+                break
+            yield rows
+
+class NumpyStore:
+    '''Series kept in RAM as float64 arrays over interned integer keys.
+
+    Produces the same results as SqliteStore, with joins done by
+    np.searchsorted over key-sorted arrays.
+    '''
+    OPS = {'>': 'greater', '<': 'less'}
+
+    def __init__(self):
+        if np is None:
+            raise RuntimeError('numpy is required for this store')
+        self.kids = {}  # (cnum, contr) -> key id
+        self.keys = []  # key id -> (cnum, contr)
+        self.pending = {}
+        self.ids = {}  # sidx -> key ids (sorted once sealed)
+        self.values = {}  # sidx -> values, parallel to ids
+
+    def add(self, sidx, keys, values):
+        ids, vals = self.pending.setdefault(sidx, (array('q'), array('d')))
+        kids, known = self.kids, self.keys
+        for key in keys:
+            kid = kids.get(key)
+            if kid is None:
+                kid = kids[key] = len(known)
+                known.append(key)
+            ids.append(kid)
+        vals.extend(values)
+
+    def finish(self, sidx, check_dups=True):
+        ids, vals = self.pending.pop(sidx, (array('q'), array('d')))
+        ids, vals = np.frombuffer(ids, dtype=np.int64), np.frombuffer(vals, dtype=np.float64)
+        valid = ~np.isnan(vals)
+        dups = []
+        if check_dups and len(ids):
+            order = np.argsort(ids, kind='stable')
+            sids, svalid = ids[order], valid[order].astype(np.int64)
+            starts = np.flatnonzero(np.r_[True, sids[1:] != sids[:-1]])
+            # Good rows strictly before each row, within its key group
+            before = np.cumsum(svalid) - svalid
+            before -= np.repeat(before[starts], np.diff(np.r_[starts, len(sids)]))
+            dids, counts = np.unique(sids[before > 0], return_counts=True)
+            dups = sorted((self.keys[kid], n) for kid, n in zip(dids.tolist(), counts.tolist()))
+        self.ids[sidx], self.values[sidx] = ids[valid], vals[valid]
+        return dups
+
+    def seal(self):
+        '''Renumber keys in (cnum, contr) order and sort every series by key; call once all series are in.'''
+        order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        self.keys = [self.keys[i] for i in order]
+        self.kids = None
+        for sidx, ids in self.ids.items():
+            ids = rank[ids]
+            order = np.argsort(ids, kind='stable')
+            self.ids[sidx], self.values[sidx] = ids[order], self.values[sidx][order]
+
+    def reconnect(self):
+        pass
+
+    def trace(self, callback):
+        pass
+
+    def count(self, idx):
+        return len(self.ids[idx])
+
+    def _join(self, idx, base=0):
+        '''Index arrays (into series base, into series idx) of every joined pair of rows.'''
+        a, b = self.ids[base], self.ids[idx]
+        lo, hi = np.searchsorted(b, a, 'left'), np.searchsorted(b, a, 'right')
+        counts = hi - lo
+        ia = np.repeat(np.arange(len(a)), counts)
+        ib = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+        return ia, ib
+
+    def pairs(self, idx, base=0):
+        a, b = self.ids[base], self.ids[idx]
+        first = np.searchsorted(a, a, 'left')
+        lo = np.searchsorted(b, a, 'left')
+        hit = lo < len(b)
+        hit[hit] = b[lo[hit]] == a[hit]
+        xs, ys = self.values[base][first[hit]], self.values[idx][lo[hit]]
+        ua, ub = np.unique(a), np.unique(b)
+        common = np.count_nonzero(np.isin(ua, ub, assume_unique=True))
+        nx, ny = len(ua) - common, len(ub) - common
+        for i in range(0, len(xs), BATCH):
+            yield xs[i:i + BATCH].tolist(), ys[i:i + BATCH].tolist(), 0, 0
+        yield [], [], nx, ny
+
+    def ordered(self, idx, comparing, base=0):
+        if comparing:
+            ia, ib = self._join(idx, base)
+            vals = np.sort(self.values[idx][ib] - self.values[base][ia])
+        else:
+            vals = np.sort(self.values[idx])
+        return len(vals), (vals[i:i + BATCH].tolist() for i in range(0, len(vals), BATCH))
+
+    def bounds(self, idx, comparing=False, base=0):
+        if comparing:
+            ia, ib = self._join(idx, base)
+            vals = self.values[idx][ib] - self.values[base][ia]
+        else:
+            vals = self.values[idx]
+        if not len(vals):
+            return None, None
+        return vals.min().item(), vals.max().item()
+
+    @staticmethod
+    def _bins(v, bins):
+        '''(in range mask, bin numbers) of v in bins, computed as SqliteStore does.'''
+        lo, hi, n = bins
+        return (v >= lo) & (v <= hi), np.minimum(((v - lo) / ((hi - lo) / n)).astype(np.int64), n - 1)
+
+    def histogram(self, idx, xbins, ybins=None, base=0):
+        if ybins is None:
+            ok, bx = self._bins(self.values[idx], xbins)
+            return np.bincount(bx[ok], minlength=xbins[2]).tolist()
+        ia, ib = self._join(idx, base)
+        okx, bx = self._bins(self.values[base][ia], xbins)
+        oky, by = self._bins(self.values[idx][ib], ybins)
+        ok = okx & oky
+        return np.bincount(bx[ok] * ybins[2] + by[ok], minlength=xbins[2] * ybins[2]).tolist()
+
+    def differences(self, idx, base=0):
+        ia, ib = self._join(idx, base)
+        vals = self.values[idx][ib] - self.values[base][ia]
+        return (vals[i:i + BATCH].tolist() for i in range(0, len(vals), BATCH))
+
+    def quadrants(self, sidx, base=0):
+        ia, ib = self._join(sidx, base)
+        v1, v2 = self.values[base][ia], self.values[sidx][ib]
+        quads = np.zeros(len(ia), dtype=np.int64)
+        for q, (s1o, s2o) in QUADS.items():
+            quads[getattr(np, self.OPS[s1o])(v1, 0) & getattr(np, self.OPS[s2o])(v2, 0)] = q
+        kids, keys = self.ids[base][ia], self.keys
+        for i in range(0, len(ia), BATCH):
+            sl = slice(i, i + BATCH)
+            yield [(q,) + keys[kid] + (x, y) for q, kid, x, y in zip(quads[sl].tolist(), kids[sl].tolist(), v1[sl].tolist(), v2[sl].tolist())]
+
+    def verdicts(self, sidx, pos, neg, base=0):
+        ia, ib = self._join(sidx, base)
+        v1, v2 = self.values[base][ia], self.values[sidx][ib]
+        def bands(v):
+            b = np.sign(v).astype(np.int64)
+            for t in pos:
+                b += v >= t
+            for t in neg:
+                b -= v <= t
+            return b
+        b1, b2 = bands(v1), bands(v2)
+        kids, keys = self.ids[base][ia], self.keys
+        for i in range(0, len(ia), BATCH):
+            sl = slice(i, i + BATCH)
+            yield [(x, y) + keys[kid] + (vx, vy) for x, y, kid, vx, vy in zip(b1[sl].tolist(), b2[sl].tolist(), kids[sl].tolist(), v1[sl].tolist(), v2[sl].tolist())]
+
+class StoreView:
+    '''The series of one figure within a (possibly shared) store.
+
+    Series are numbered as in the figure, with its series 0 as the base of
+    every comparison; sids maps them to series of the store, and sketches
+    maps (series of the store, k) to any KLL sketch of it.
+    '''
+    def __init__(self, store, sids, sketches=None):
+        self.store, self.sids = store, sids
+        self.sketches = sketches if sketches is not None else {}
+
+    def count(self, idx):
+        return self.store.count(self.sids[idx])
+
+    def pairs(self, idx):
+        return self.store.pairs(self.sids[idx], self.sids[0])
+
+    def ordered(self, idx, comparing):
+        return self.store.ordered(self.sids[idx], comparing, self.sids[0])
+
+    def differences(self, idx):
+        return self.store.differences(self.sids[idx], self.sids[0])
+
+    def bounds(self, idx, comparing=False):
+        return self.store.bounds(self.sids[idx], comparing, self.sids[0])
+
+    def histogram(self, idx, xbins, ybins=None):
+        return self.store.histogram(self.sids[idx], xbins, ybins, self.sids[0])
+
+    def sketch(self, idx, k):
+        return self.sketches[self.sids[idx], k]
+
+    def quadrants(self, sidx):
+        return self.store.quadrants(self.sids[sidx], self.sids[0])
+
+    def verdicts(self, sidx, pos, neg):
+        return self.store.verdicts(self.sids[sidx], pos, neg, self.sids[0])
+
+STORES = {
+    'sqlite': SqliteStore,
+    'numpy': NumpyStore,
+}
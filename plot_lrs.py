@@ -1,4 +1,12 @@
-import argparse, os, sys, csv, colorsys, math, sqlite3
+import argparse, sys, csv, colorsys, bisect, multiprocessing, json, tempfile, itertools
+from array import array
+import lrstore, lrseries, lrsketch, lrprofile
+from gpbinary import BINARY
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
 
 parser = argparse.ArgumentParser(description='Generate versus LR plots')
 
@@ -10,10 +18,12 @@ parser.add_argument('--races', default='Black,Hispanic,Caucasian,Asian,LR', help
 parser.add_argument('--agg', default='min', help='Aggregator function over races')
 parser.add_argument('--map', default='log10', help='Mapping function over data points')
 parser.add_argument('--series-map', action='append', default=[], help='"idx:func"--set the mapping function for one series')
-parser.add_argument('--series-top', action='append', default=[], help='"idx:num"--select only the top num values from the series')
-parser.add_argument('--series-bottom', action='append', default=[], help='"idx:num"--select only the bottom num values from the series')
-parser.add_argument('basename', help='Basename of files to generate (.ps, .data)')
+parser.add_argument('--series-top', action='append', default=[], help='"idx:num"--select only the top num values from the series (ties go to the earliest row); unless --no-sanity, every key is still remembered to count duplicates')
+parser.add_argument('--series-bottom', action='append', default=[], help='"idx:num"--select only the bottom num values from the series (applied before --series-top)')
+parser.add_argument('basename', nargs='?', help='Basename of files to generate (.ps, .data)')
 parser.add_argument('--exten', default='ps', help='Output graphic file extension')
+parser.add_argument('--binary', action='store_true', help='Write plot data packed into BASENAME.bin instead of as text in the .gp file')
+parser.add_argument('--binary-type', default='float64', choices=sorted(BINARY), help='Value type for --binary (default float64; float32 halves the file, but rounds values)')
 parser.add_argument('--terminal', default='postscript color', help='GNUPlot terminal to use (with options)')
 parser.add_argument('--dot-size', type=int, default=2, help='Dot size (actually lw) to specify for each plot')
 parser.add_argument('--xr', help='Set X range (GNUPlot syntax)')
@@ -27,31 +37,38 @@ parser.add_argument('--clear-quartile-pt', dest='quartile_pts', action='store_co
 parser.add_argument('--no-sanity', dest='no_sanity', action='store_true', help='Turn off some sanity checks for performance')
 parser.add_argument('--no-drop', dest='no_drop', action='store_true', help='Fail immediately if a data point is dropped')
 parser.add_argument('--col-offset', dest='col_offset', type=float, default=0.33, help='Hue offset in [0, 1] for graph series colors')
-parser.add_argument('--quads', dest='quads', action='store_true', help='Enumerate keys for quadrants in the non-primary series')
+parser.add_argument('--quads', dest='quads', action='store_true', help='Enumerate keys for quadrants in the non-primary series (keys on an axis go to .axis.csv)')
+parser.add_argument('--quad-title', action='store_true', help='Add the quadrant counts of each non-primary series to the plot title')
+parser.add_argument('--quad-summary', action='store_true', help='Write the quadrant counts of each non-primary series to BASENAME.quads.csv')
 parser.add_argument('--verbeq', dest='verbeq', action='store_true', help='Show verbal equivalency lines on the LR axes (check the defaults!)')
 parser.add_argument('--verbeq-steps', dest='verbeq_steps', type=int, default=3, help='Steps in the verbal equivalency in either direction (default 3)')
 parser.add_argument('--verbeq-range', dest='verbeq_range', type=float, default=1.0, help='Difference in log10 LR considered a step (default 1.0)')
 parser.add_argument('--every', dest='every', type=int, help='Provide progress after importing this many rows from each series')
-parser.add_argument('--mode', dest='mode', default='scatter', help='Graph mode (default: scatter)')
+parser.add_argument('--cache', help='Keep the raw per-race columns of ingested series in this file and reuse them while their input files are unchanged, whatever --agg, --map or (fewer) --races')
+parser.add_argument('-j', '--jobs', type=int, default=1, help='Read up to this many series at once in worker processes (default 1)')
+parser.add_argument('--profile', action='store_true', help='Print the wall and CPU time, rows/sec, SQLite statements and peak RSS of each phase (per series and figure) when done')
+parser.add_argument('--profile-json', help='Also write the --profile records to this file as JSON (implies --profile)')
+parser.add_argument('--manifest', help='Render every figure listed in this JSON or TOML file, reading each series once; see --help-manifest')
+parser.add_argument('--help-manifest', action='store_true', help='Print help about --manifest (and do nothing else)')
+parser.add_argument('--mode', dest='mode', default='scatter', help='Graph mode: scatter (default), percentile, percentile-nocmp, changeover (verdicts changing between two series; thresholds from --veq-schema/--veq-add), or density (binned counts; see --bins)')
+parser.add_argument('--bins', default='100', help='Bins for density mode: "n", or "nx,ny" for the primary and other series (default 100)')
+parser.add_argument('--density-1d', action='store_true', help='In density mode, histogram every series on its own instead of against the primary series')
+parser.add_argument('--density-log', action='store_true', help='In density mode, color 2D bins on a log scale')
 parser.add_argument('--backing', dest='backing', help='Use this file as data backing (if RAM is insufficient)')
+parser.add_argument('--store', default='sqlite', choices=sorted(lrstore.STORES), help='Series store: sqlite (default; see --backing) or numpy (in RAM, much faster on large series)')
 parser.add_argument('--veq', action='store_true', help='Add "verbal equivalence" lines (only for non-comparative plots)')
 parser.add_argument('--veq-schema', help='"Verbal equivalence" schema (usually per program)')
 parser.add_argument('--veq-schemas', help='Instead of doing anything else, print out the known schemata and exit')
 parser.add_argument('--veq-add', action='append', default=[], help='"name:value:color"--add an equivalence with the given name for the given value')
 parser.add_argument('--zc', action='store_true', help='Annotate the zero crossing of each series on percentile plots')
 parser.add_argument('--zc-veq', action='store_true', help='Annotate the verbal equivalent crossings of each series on percentile plots')
+parser.add_argument('--max-points', type=int, help='Decimate each percentile curve to at most this many points, keeping it within about 4/N of the percentiles and 2/N of the value range (quartiles, crossings and both ends are always kept)')
+parser.add_argument('--approx-percentile', action='store_true', help='Take percentile curves, quartiles and crossings from a KLL sketch of each series (bounded memory, no sort; the rank error goes in the title)')
+parser.add_argument('--approx-k', type=int, default=200, help='Sketch size for --approx-percentile (default 200, for about 1.3%% rank error)')
 parser.add_argument('--zc-add', action='append', default=[], help='"sidx:value[:label[:color]]"--add a crossing mark for this series at this exact value')
 
 args = parser.parse_args()
 
-AGGS = {
-    'min': min,
-    'max': max,
-}
-MAPS = {
-    'id': lambda x: x,
-    'log10': math.log10,
-}
 PRETTY_MAPS = {
     'id': '',
     'log10': 'log_{10}',
@@ -65,18 +82,6 @@ if args.veq_schemas:
         print(key)
     exit()
 
-veqs = []
-if args.veq_schema:
-    veqs.extend(VEQS[args.veq_schema])
-
-if args.veq_add:
-    for val in args.veq_add:
-        name, value, col = val.split(':')
-        veqs.append((name, float(value), col))
-
-if args.veq and not veqs:
-    print('WARN: --veq specified but no --veq-add or --veq-schema; nothing will be added')
-
 def gpesc(s):
     return s.replace('_', '\\\\_')
 
@@ -107,231 +112,347 @@ title.
 
 An empty constraint list does no filtering.
 
+The filename may also be a batch tool database (SQLite, with a batch_data
+table), read directly rather than through batchtool_extract.py: Case and
+Contributor are derived from the evidence and profile paths in the same way,
+and races (and any other constrained columns) are read from odata. Since the
+values there are already log10 LRs, they aren't exponentiated and logged
+again, so --map log10 gives them exactly.
+
 If, after filtering, a series consists of a single sample and the mode is
 percentile, a single horizontal line is plotted instead.''')
     exit()
 
-aggf = AGGS.get(args.agg)
-if not aggf:
-    print(f'Bad aggregate function {args.agg}!', file=sys.stderr)
-    exit(1)
-mapf = MAPS.get(args.map)
-if not mapf:
-    print(f'Bad mapping function {args.map}!', file=sys.stderr)
-    exit(1)
-smap = {}
-for sm in args.series_map:
-    ix, _, mf = sm.partition(':')
-    ix = int(ix)
-    if mf not in MAPS:
-        print(f'Bad mapping function {mf}!', file=sys.stderr)
-        exit(1)
-    smap[ix] = MAPS[mf]
-stop, sbot = {}, {}
-for st in args.series_top:
-    ix, _, v = st.partition(':')
-    stop[int(ix)] = int(v)
-for sb in args.series_bottom:
-    ix, _, v = st.partition('_')
-    sbot[int(ix)] = int(v)
-races = args.races.split(',')
-colors = [
-    f'#77{r:02x}{g:02x}{b:02x}'
-    for r, g, b in [
-        map(lambda x: int(255*x), colorsys.hsv_to_rgb(args.col_offset + i/(1+len(args.series)), 1.0, 0.5)) for i in range(len(args.series))
+if args.help_manifest:
+    print('''A manifest lists figures to render from one run, as JSON:
+
+{
+    "args": ["--races", "Black,Caucasian", "--exten", "png", "--terminal", "png"],
+    "figures": [
+        ["-s", "a.csv", "-s", "b.csv:Dropout=PHOM", "fig1"],
+        ["-s", "a.csv", "-s", "b.csv:Dropout=PHOM", "fig2", "--mode", "percentile"]
     ]
+}
+
+or the same keys in TOML (for a file ending in .toml):
+
+args = ["--races", "Black,Caucasian"]
+figures = [
+    ["-s", "a.csv", "-s", "b.csv:Dropout=PHOM", "fig1"],
 ]
-series_crossings = {}
-for cross in args.zc_add:
-    parts = cross.split(':')
-    idx = int(parts[0])
-    val = float(parts[1])
-    lbl = str(val) if len(parts) < 3 else parts[2]
-    col = colors[idx] if len(parts) < 4 else parts[3]
-    if col == 'COMPLEMENT':
-        col = colors[idx]
-        r, g, b = int(col[3:5], 16), int(col[5:7], 16), int(col[7:9], 16)
-        col = f'#77{255-r:02x}{255-g:02x}{255-b:02x}'
-    if idx not in series_crossings:
-        series_crossings[idx] = []
-    series_crossings[idx].append((val, lbl, col))
 
-print('Reading series...', file=sys.stderr)
-db = sqlite3.connect(args.backing if args.backing else ':memory:')
-cur = db.cursor()
-cur.execute('DROP INDEX IF EXISTS series_key')
-cur.execute('DROP TABLE IF EXISTS series')
-cur.execute('CREATE TABLE series (idx, cnum, contr, value)')
-cur.execute('CREATE INDEX series_key ON series (cnum, contr)')
-titles = []
-for sidx, sdesc in enumerate(args.series):
-    parts = sdesc.split(':')
-    fn = parts[0]
-    mf = smap.get(sidx, mapf)
-    if len(parts) < 2 or not parts[1]:
-        filt = lambda row: True
-    else:
-        conds = []
-        for part in parts[1].split(','):
-            if '=' in part:
-                col, _, val = part.partition('=')
-                print(f'Series {sidx}: {sdesc}: condition {col} == {val}')
-                conds.append(lambda row, col=col, val=val: row[col] == val)
-            elif '^' in part:
-                col, _, val = part.partition('^')
-                print(f'Series {sidx}: {sdesc}: condition {col} startswith {val}')
-                conds.append(lambda row, col=col, val=val: row[col].startswith(val))
-            elif '$' in part:
-                col, _, part = part.partition('$')
-                print(f'Series {sidx}: {sdesc}: condition {col} endswith {val}')
-                conds.append(lambda row, col=col, val=val: row[col].endswith(val))
-            else:
-                raise ValueError(f"Couldn't interpret condition {part} of series {sdesc}")
-        filt = lambda row, conds=conds: all(c(row) for c in conds)
-    if len(parts) < 3 or not parts[2]:
-        titles.append(gpesc(sdesc))
-    else:
-        titles.append(gpesc(parts[2]))
-    
+Each figure is the command line of a single run, after the common "args".
+A series with the same file, constraints, --races, --agg, mapping and
+selection in several figures is read and ingested only once; series that
+differ only in --races, --agg or mapping still share one read of the file.
+
+The store (--store, --backing), --cache and --jobs come from the command
+line running the manifest, not from the figures; with --jobs, figures are
+also rendered in parallel.''')
+    exit()
+
+if args.manifest is None and args.basename is None:
+    parser.error('the following arguments are required: basename (or --manifest)')
+
+def series_plan(args):
+    '''Check a figure's ingest options; returns [(sdesc, (races, agg, map, bottom, top))] for its series.
+
+    Series with the same file, constraints and options ingest the same rows,
+    whatever their titles, so figures can share them.
+    '''
+    if args.agg not in lrseries.AGGS:
+        print(f'Bad aggregate function {args.agg}!', file=sys.stderr)
+        exit(1)
+    if args.map not in lrseries.MAPS:
+        print(f'Bad mapping function {args.map}!', file=sys.stderr)
+        exit(1)
+    smap = {}
+    for sm in args.series_map:
+        ix, _, mf = sm.partition(':')
+        ix = int(ix)
+        if mf not in lrseries.MAPS:
+            print(f'Bad mapping function {mf}!', file=sys.stderr)
+            exit(1)
+        smap[ix] = mf
+    stop, sbot = {}, {}
+    for st in args.series_top:
+        ix, _, v = st.partition(':')
+        stop[int(ix)] = int(v)
+    for sb in args.series_bottom:
+        ix, _, v = sb.partition(':')
+        sbot[int(ix)] = int(v)
+    races = tuple(args.races.split(','))
+    return [(sdesc, (races, args.agg, smap.get(sidx, args.map), sbot.get(sidx), stop.get(sidx))) for sidx, sdesc in enumerate(args.series)]
+
+def ingest(store, sid, sdesc, source, opts, args, sketches=()):
+    '''Reduce one series' raw batches into the store as series sid, per opts from series_plan(); returns (drops, dups).
+
+    With --series-bottom/--series-top the selection is made as the rows
+    stream past, so only the survivors ever reach the store (and sketches).
+    '''
+    races, agg, mapping, bottom, top = opts
     drops = 0
-    rdr = csv.DictReader(open(fn))
-    for idx, row in enumerate(rdr):
-        if args.every is not None and idx % args.every == 0:
-            print(f'Series {sidx} ({sdesc}): imported {idx} so far...')
-        if not filt(row):
-            continue
-        key = (row['Case'], row['Contributor'])
-        if not args.no_sanity:
-            cur.execute('SELECT * FROM series WHERE idx=? AND cnum=? AND contr=?', (sidx,) + key)
-            if cur.fetchone() is not None:
-                print(f'WARN: dup key {key} in series {sdesc}!', file=sys.stderr)
-        try:
-            cur.execute('INSERT INTO series VALUES (?, ?, ?, ?)', (sidx,) + key + (mf(aggf(float(row[i]) for i in races if i in rdr.fieldnames)),))
-        except ValueError:
-            drops += 1
-            if args.no_drop:
+    sel = [(bottom, False)] if bottom is not None else []
+    sel += [(top, True)] if top is not None else []
+    dupc = lrseries.DupCounter() if sel and not args.no_sanity else None
+    log10 = lrseries.is_batch_db(lrseries.parse_spec(sdesc)[0])
+    def batches():
+        nonlocal drops
+        for batch in source:
+            keys, values, bdrops = lrseries.reduce_batch(batch, races, agg, mapping, log10)
+            if bdrops and args.no_drop:
+                key = next(key for key, v in zip(keys, values) if v != v)
                 print(f'FATAL: Failed to add key {key} in series {sdesc}:')
-                raise
-    print(f'Series {sidx} ({sdesc}) imported with {drops} drops')
-    db.commit()
-
-print('Postprocessing series...')
-for sidx, bot in sbot.items():
-    print(f'Series {sidx}: bottom {bot}')
-    cur.execute('SELECT cnum, contr, value FROM series WHERE idx=? ORDER BY value ASC LIMIT ?', (sidx, bot))
-    rows = cur.fetchall()
-    print(f'... selected {len(rows)} rows')
-    cur.execute('DELETE FROM series WHERE idx=?', (sidx,))
-    for cnum, contr, value in rows:
-        cur.execute('INSERT INTO series (idx, cnum, contr, value) VALUES (?, ?, ?, ?)', (sidx, cnum, contr, value))
-    db.commit()
-
-for sidx, top in stop.items():
-    print(f'Series {sidx}: top {top}')
-    cur.execute('SELECT cnum, contr, value FROM series WHERE idx=? ORDER BY value DESC LIMIT ?', (sidx, top))
-    rows = cur.fetchall()
-    print(f'... selected {len(rows)} rows')
-    cur.execute('DELETE FROM series WHERE idx=?', (sidx,))
-    for cnum, contr, value in rows:
-        cur.execute('INSERT INTO series (idx, cnum, contr, value) VALUES (?, ?, ?, ?)', (sidx, cnum, contr, value))
-    db.commit()
-
-#titles = [
-#    f'{gpesc(ser.partition(":")[0])}:{gpesc(",".join(p.partition("=")[2] for p in ser.partition(":")[2].split(",")))}'
-#    for ser in args.series
-#]
-if args.mode == 'scatter':
-    cur.execute('SELECT cnum, contr FROM series WHERE idx=0')
-    keys = cur.fetchall()
-    keys.sort()
-    keyset = set(keys)
-    plots = []
-    pstyles = [args.pts[i % len(args.pts)] for i in range(len(args.series))]
-    print(f'generated {len(keys)} keys', file=sys.stderr)
-
-    print('Writing plot file...')
-    pf = open(args.basename + '.gp', 'w')
-    pf.write(f'''set terminal {args.terminal}
+                raise ValueError(f'No usable value for {key}')
+            drops += bdrops
+            if dupc is not None:
+                dupc.feed(keys, values)
+            yield keys, values
+
+    if not sel:
+        for keys, values in batches():
+            store.add(sid, keys, values)
+            for sk in sketches:
+                sk.update(values)
+        return drops, store.finish(sid, not args.no_sanity)
+
+    rows = (row for keys, values in batches() for row in zip(keys, values) if row[1] == row[1])
+    for num, top in sel:
+        rows = lrseries.select(rows, num, top)
+        print(f'Series {sid}: {"top" if top else "bottom"} {num}')
+        print(f'... selected {len(rows)} rows')
+    store.add(sid, [row[0] for row in rows], [row[1] for row in rows])
+    for sk in sketches:
+        sk.update(row[1] for row in rows)
+    store.finish(sid, False)
+    return drops, dupc.dups() if dupc is not None else []
+
+class DataBlock:
+    '''A block of plot data: an inline heredoc, or with binf (--binary), a run of packed records in it.
+
+    Data is written a chunk of columns at a time; once closed, ref is how
+    a plot command reads it.
+    '''
+    def __init__(self, pf, name, cols, comment, binf=None, btype='float64'):
+        self.pf, self.name, self.cols = pf, name, cols
+        self.binf, self.btype = binf, btype
+        self.records = 0
+        self.line = '\t'.join(['{}'] * cols) + '\n'
+        if self.binf is None:
+            pf.write(f'${name} <<EOD\n{comment}\n')
+        else:
+            self.skip = self.binf.tell()
+
+    def write(self, *cols):
+        if self.binf is None:
+            self.pf.write(''.join(map(self.line.format, *cols)))
+            return
+        code, fmt = BINARY[self.btype]
+        n = len(cols[0])
+        packed = array(code, bytes(array(code).itemsize * n * self.cols))
+        for i, col in enumerate(cols):
+            packed[i::self.cols] = array(code, col)
+        self.binf.write(packed.tobytes())
+        self.records += n
+
+    def close(self):
+        if self.binf is None:
+            self.pf.write('EOD\n')
+
+    @property
+    def ref(self):
+        if self.binf is None:
+            return f'${self.name}'
+        code, fmt = BINARY[self.btype]
+        return f'"{self.binf.name}" binary skip={self.skip} record={self.records} format="{fmt * self.cols}"'
+
+# True if a multiple of --every falls in [start, start + n), for progress over chunks
+def every_crossed(every, start, n):
+    return every is not None and n > 0 and (start + n - 1) // every * every >= start
+
+def parse_range(r):
+    '''(lo, hi) of a gnuplot range like "[-5:5]", with None for an open ("*" or empty) end.'''
+    return tuple(None if end.strip() in ('', '*') else float(end) for end in r.strip().strip('[]').partition(':')[::2])
+
+# Bins (lo, hi, n) for a store's histogram(): over a --xr/--yr range if given, filling any open end from bounds
+# (of series with data; there must be one unless the range is closed)
+def bins_over(r, bounds, n):
+    lo, hi = parse_range(r) if r else (None, None)
+    bounds = [b for b in bounds if b[0] is not None]
+    lo = min(b[0] for b in bounds) if lo is None else lo
+    hi = max(b[1] for b in bounds) if hi is None else hi
+    if hi <= lo:
+        lo, hi = lo - 0.5, lo + 0.5
+    return lo, hi, n
+
+# Track where a sorted stream of chunks first reaches val: pt is None until it's
+# reached, False if even the very first value is past it (no crossing), and
+# otherwise (fraction, value, index) of the first value >= val
+def crossing(pt, chunk, kidx, denom, val):
+    if pt is not None:
+        return pt
+    i = bisect.bisect_left(chunk, val)
+    if i == len(chunk):
+        return None
+    if kidx + i == 0:
+        return False
+    return ((kidx + i) / denom, chunk[i], kidx + i)
+
+def render(args, store):
+    '''Write one figure's plot file (and data) from the series of a StoreView.'''
+    veqs = []
+    if args.veq_schema:
+        veqs.extend(VEQS[args.veq_schema])
+
+    if args.veq_add:
+        for val in args.veq_add:
+            name, value, col = val.split(':')
+            veqs.append((name, float(value), col))
+
+    if args.veq and not veqs:
+        print('WARN: --veq specified but no --veq-add or --veq-schema; nothing will be added')
+
+    colors = [
+        f'#77{r:02x}{g:02x}{b:02x}'
+        for r, g, b in [
+            map(lambda x: int(255*x), colorsys.hsv_to_rgb(args.col_offset + i/(1+len(args.series)), 1.0, 0.5)) for i in range(len(args.series))
+        ]
+    ]
+    series_crossings = {}
+    for cross in args.zc_add:
+        parts = cross.split(':')
+        idx = int(parts[0])
+        val = float(parts[1])
+        lbl = str(val) if len(parts) < 3 else parts[2]
+        col = colors[idx] if len(parts) < 4 else parts[3]
+        if col == 'COMPLEMENT':
+            col = colors[idx]
+            r, g, b = int(col[3:5], 16), int(col[5:7], 16), int(col[7:9], 16)
+            col = f'#77{255-r:02x}{255-g:02x}{255-b:02x}'
+        if idx not in series_crossings:
+            series_crossings[idx] = []
+        series_crossings[idx].append((val, lbl, col))
+
+    specs = [lrseries.parse_spec(sdesc) for sdesc in args.series]
+    titles = [gpesc(title if title is not None else sdesc) for sdesc, (fn, conds, title) in zip(args.series, specs)]
+
+    quad_title = ''
+    if args.quads or args.quad_title or args.quad_summary:
+        print('Writing quadrants...' if args.quads else 'Counting quadrants...')
+        if args.quad_summary:
+            sf = open(f'{args.basename}.quads.csv', 'w', newline='')
+            sw = csv.writer(sf)
+            sw.writerow(['Series', 'Quad1', 'Quad2', 'Quad3', 'Quad4', 'Axis'])
+
+        for sidx in range(1, len(args.series)):
+            counts = [0 for i in range(len(lrstore.QUADS) + 1)]
+            if args.quads:
+                fs = [open(f'{args.basename}.ser{sidx}.{f"quad{quad}" if quad else "axis"}.csv', 'w') for quad in range(len(counts))]
+                for f in fs:
+                    f.write('Case,Contributor,PrimValue,SeriesValue\n')
+            for chunk in store.quadrants(sidx):
+                for quad, case, contr, s1v, s2v in chunk:
+                    counts[quad] += 1
+                    if args.quads:
+                        fs[quad].write(f'{case},{contr},{s1v},{s2v}\n')
+            if args.quads:
+                for f in fs:
+                    f.close()
+            print(f'Series {sidx} ({args.series[sidx]}) quadrants {", ".join(map(str, counts[1:]))}; {counts[0]} on an axis')
+            if args.quad_summary:
+                sw.writerow([args.series[sidx]] + counts[1:] + [counts[0]])
+            quad_title += f'\\n{titles[sidx]}: I {counts[1]}, II {counts[2]}, III {counts[3]}, IV {counts[4]}, axes {counts[0]}'
+        if args.quad_summary:
+            sf.close()
+        if not args.quad_title:
+            quad_title = ''
+
+    #titles = [
+    #    f'{gpesc(ser.partition(":")[0])}:{gpesc(",".join(p.partition("=")[2] for p in ser.partition(":")[2].split(",")))}'
+    #    for ser in args.series
+    #]
+    binf = None
+    if args.binary:
+        binf = open(args.basename + '.bin', 'wb')
+
+    if args.mode == 'scatter':
+        nkeys = store.count(0)
+        plots = []
+        pstyles = [args.pts[i % len(args.pts)] for i in range(len(args.series))]
+        print(f'generated {nkeys} keys', file=sys.stderr)
+
+        print('Writing plot file...')
+        pf = open(args.basename + '.gp', 'w')
+        pf.write(f'''set terminal {args.terminal}
 set output "{args.basename}.{args.exten}"
 set zeroaxis
 set key right bottom font "sans,8" tc variable
 set size square
 ident(x) = x
 ''')
-    if args.verbeq:
-        for eqr in range(args.verbeq_steps):
-            val = (eqr+1) * args.verbeq_range
-            for v in (val, -val):
-                pf.write(f'set arrow from graph 0, first {v} to graph 1, first {v} nohead lw 0.5 lt 2\n')
-                pf.write(f'set arrow from {v}, graph 0 to {v}, graph 1 nohead lw 0.5 lt 2\n')
-    if args.xr:
-        pf.write(f'set xrange {args.xr}\n')
-    if args.yr:
-        pf.write(f'set yrange {args.yr}\n')
-    pmapf = PRETTY_MAPS[args.map]
-    pmaps = ''
-    if pmapf:
-        pmaps = f' ({pmapf})'
-    if args.xl is None:
-        args.xl = f"LR of {titles[0]}{pmaps}"
-    if args.yl is None:
-        args.yl = f"LR{pmaps}"
-    if args.xl is not None:
-        pf.write(f'set xlabel "{args.xl}"\n')
-    if args.yl is not None:
-        pf.write(f'set ylabel "{args.yl}"\n')
-
-    title = f'x = {titles[0]}'
-    if args.title:
-        title = args.title + ': ' + title
-    if args.no_title:
-        pf.write(f'set notitle\n')
-    else:
-        pf.write(f'set title "{title}"\n')
-
-    print('Writing data...')
-    for idx, sdesc in enumerate(args.series):
-        if not args.no_sanity:
-            cur.execute('SELECT cnum, contr FROM series WHERE idx=?', (idx,))
-            dkeys = set(cur.fetchall())
-            nx, ny = len(keyset - dkeys), len(dkeys - keyset)
-            if nx:
-                print(f'WARN: series {args.series[idx]} is missing {nx} keys', file=sys.stderr)
-            if ny:
-                print(f'WARN: series {args.series[idx]} has {ny} keys that won\'t be displayed', file=sys.stderr)
-
-        dvar = f'ser{idx}'
-        if idx != 0:
-            plots.append(f'${dvar} with points lw {args.dot_size} pt {pstyles[idx-1]} lc rgb "{colors[idx-1]}" title "{titles[idx]}"')
-        pf.write(f'${dvar} <<EOD\n')
-        pf.write(f'# series {args.series[0]} vs {args.series[idx]}\n')
-        for kidx, k in enumerate(keys):
-            if args.every is not None and kidx % args.every == 0:
-                print(f'Series {idx} ({sdesc}): writeout progress {kidx}...')
-            cur.execute('SELECT value FROM series WHERE idx=? AND cnum=? AND contr=?', (idx,) + k)
-            v = cur.fetchone()
-            if v is None:
-                continue
-            v = v[0]
-            cur.execute('SELECT value FROM series WHERE idx=0 AND cnum=? AND contr=?', k)
-            v0 = cur.fetchone()[0]  # Shouldn't fail
-
-            pf.write(f'{v0}\t{v}\n')
-        pf.write('EOD\n')
-        print(f'Series {idx} ({sdesc}) done writing')
-
-    plots.append(f'ident(x) with lines lc rgb "#77000000" lw 1 title "y=x ({titles[0]})"')
-
-    if args.veq and veqs:
-        for name, val, col in veqs:
-            plots.append(f'{val} title {name!r} lc rgbcolor "{col}"')
-    pf.write(f'plot {", ".join(plots)}\n')
-    pf.close()
-elif args.mode in ('percentile', 'percentile-nocmp'):
-    comparing = (args.mode == 'percentile')
-    print('Writing plot file...')
-    pf = open(args.basename + '.gp', 'w')
-    pf.write(f'''set terminal {args.terminal}
+        if args.verbeq:
+            for eqr in range(args.verbeq_steps):
+                val = (eqr+1) * args.verbeq_range
+                for v in (val, -val):
+                    pf.write(f'set arrow from graph 0, first {v} to graph 1, first {v} nohead lw 0.5 lt 2\n')
+                    pf.write(f'set arrow from {v}, graph 0 to {v}, graph 1 nohead lw 0.5 lt 2\n')
+        if args.xr:
+            pf.write(f'set xrange {args.xr}\n')
+        if args.yr:
+            pf.write(f'set yrange {args.yr}\n')
+        pmapf = PRETTY_MAPS[args.map]
+        pmaps = ''
+        if pmapf:
+            pmaps = f' ({pmapf})'
+        if args.xl is None:
+            args.xl = f"LR of {titles[0]}{pmaps}"
+        if args.yl is None:
+            args.yl = f"LR{pmaps}"
+        if args.xl is not None:
+            pf.write(f'set xlabel "{args.xl}"\n')
+        if args.yl is not None:
+            pf.write(f'set ylabel "{args.yl}"\n')
+
+        title = f'x = {titles[0]}'
+        if args.title:
+            title = args.title + ': ' + title
+        title += quad_title
+        if args.no_title:
+            pf.write(f'set notitle\n')
+        else:
+            pf.write(f'set title "{title}"\n')
+
+        print('Writing data...')
+        for idx, sdesc in enumerate(args.series):
+            blk = DataBlock(pf, f'ser{idx}', 2, f'# series {args.series[0]} vs {args.series[idx]}', binf, args.binary_type)
+            nx, ny, kidx = 0, 0, 0
+            for xs, ys, cnx, cny in store.pairs(idx):
+                if every_crossed(args.every, kidx, len(xs)):
+                    print(f'Series {idx} ({sdesc}): writeout progress {kidx}...')
+                blk.write(xs, ys)
+                nx, ny, kidx = nx + cnx, ny + cny, kidx + len(xs)
+            blk.close()
+            if idx != 0:
+                plots.append(f'{blk.ref} with points lw {args.dot_size} pt {pstyles[idx-1]} lc rgb "{colors[idx-1]}" title "{titles[idx]}"')
+            if not args.no_sanity:
+                if nx:
+                    print(f'WARN: series {args.series[idx]} is missing {nx} keys', file=sys.stderr)
+                if ny:
+                    print(f'WARN: series {args.series[idx]} has {ny} keys that won\'t be displayed', file=sys.stderr)
+            print(f'Series {idx} ({sdesc}) done writing')
+
+        plots.append(f'ident(x) with lines lc rgb "#77000000" lw 1 title "y=x ({titles[0]})"')
+
+        if args.veq and veqs:
+            for name, val, col in veqs:
+                plots.append(f'{val} title {name!r} lc rgbcolor "{col}"')
+        pf.write(f'plot {", ".join(plots)}\n')
+        pf.close()
+    elif args.mode in ('percentile', 'percentile-nocmp'):
+        comparing = (args.mode == 'percentile')
+        print('Writing plot file...')
+        pf = open(args.basename + '.gp', 'w')
+        pf.write(f'''set terminal {args.terminal}
 set output "{args.basename}.{args.exten}"
 set zeroaxis
 set key right bottom font "sans,8" tc variable
@@ -339,152 +460,505 @@ set size square
 set xtics ("0%%" -1, "50%%" 0, "100%%" 1)
 set xrange [-1:1]
 ''')
-    if args.xr:
-        pf.write(f'set xrange {args.xr}\n')
-    if args.yr:
-        pf.write(f'set yrange {args.yr}\n')
-    pmapf = PRETTY_MAPS[args.map]
-    pmaps = ''
-    if pmapf:
-        pmaps = f' ({pmapf})'
-    if args.xl is None:
-        args.xl = f"Percentile"
-    if args.yl is None:
-        args.yl = f'LR {" - (LR_{" + titles[0] + "})" if comparing else ""}{pmaps}'
-    if args.xl is not None:
+        if args.xr:
+            pf.write(f'set xrange {args.xr}\n')
+        if args.yr:
+            pf.write(f'set yrange {args.yr}\n')
+        pmapf = PRETTY_MAPS[args.map]
+        pmaps = ''
+        if pmapf:
+            pmaps = f' ({pmapf})'
+        if args.xl is None:
+            args.xl = f"Percentile"
+        if args.yl is None:
+            args.yl = f'LR {" - (LR_{" + titles[0] + "})" if comparing else ""}{pmaps}'
+        if args.xl is not None:
+            pf.write(f'set xlabel "{args.xl}"\n')
+        if args.yl is not None:
+            pf.write(f'set ylabel "{args.yl}"\n')
+
+        if comparing:
+            title = f'{titles[0]} as x = 0'
+            if args.title:
+                title = args.title + ': ' + title
+        else:
+            title = ''
+            if args.title:
+                title = args.title
+        title += quad_title
+        if args.approx_percentile:
+            title += ('\\n' if title else '') + f'approximate percentiles, rank error < {100*lrsketch.rank_error(args.approx_k):.2f}% (99% confidence)'
+        if args.no_title:
+            pf.write(f'set notitle\n')
+        else:
+            pf.write(f'set title "{title}"\n')
+        plots = []
+        labels = []
+
+        print('Writing data...')
+        for idx, sdesc in enumerate(args.series):
+            if idx == 0 and comparing:
+                continue
+            if args.approx_percentile:
+                if comparing:
+                    # Differences only exist in the join, so they're sketched in one unsorted pass over it
+                    sketch = lrsketch.KLL(args.approx_k)
+                    for chunk in store.differences(idx):
+                        sketch.update(chunk)
+                else:
+                    sketch = store.sketch(idx, args.approx_k)
+                summary = lrsketch.Summary(sketch)
+                total = summary.n
+            else:
+                total, chunks = store.ordered(idx, comparing)
+            if total == 0:
+                print(f'WARN: Series {idx} ({sdesc}) has no data and will not be plotted')
+                continue
+            blk = DataBlock(pf, f'ser{idx}', 2, f'# series {sdesc} percentile', binf, args.binary_type)
+            denom = max(total - 1, 1)
+            quarts = (0, total // 4, total // 2, 3 * total // 4, total - 1)
+            crossings = series_crossings.get(idx, [])
+            # Decimating, keep the first and last point of every step-sized span, and any point more than vstep above
+            # the last one kept; being sorted, those bound all the rest in both directions. What --max-points leaves
+            # after the inner quartiles and crossings is split: half to spans (two points each), half to value moves
+            step = None
+            if args.max_points and total > args.max_points:
+                budget = args.max_points - 3 - (1 if args.zc else 0) - (len(veqs) if args.zc_veq else 0) - len(crossings)
+                spans = max(budget // 4, 1)
+                step = -(-total // spans)
+                if not args.approx_percentile:
+                    lo, hi = store.bounds(idx, comparing)
+                    vstep = (hi - lo) / max(budget - 2 * spans, 1)
+            lastv = None
+            written = total if step is None else 0
+            qvals = {}
+            zpt = None
+            zpts = [None for i in veqs]
+            cpts = [None for i in crossings]
+            kidx = 0
+            if args.approx_percentile:
+                # Evenly spaced ranks, plus the quartiles; crossings are where the sketch puts them
+                def approx_crossing(val):
+                    k = summary.count_below(val)
+                    if k >= total:
+                        return None
+                    if k == 0:
+                        return False
+                    return (k / denom, summary.quantile(k), k)
+                npts = min(total, max(args.max_points - 3, 2) if args.max_points else 1000)
+                ks = sorted(set(round(i * (total - 1) / max(npts - 1, 1)) for i in range(npts)).union(quarts))
+                blk.write([2*(k/denom)-1 for k in ks], [summary.quantile(k) for k in ks])
+                written = len(ks)
+                qvals = {quart: summary.quantile(quart) for quart in quarts}
+                if args.zc:
+                    zpt = approx_crossing(0)
+                if args.zc_veq:
+                    zpts = [approx_crossing(elem[1]) for elem in veqs]
+                cpts = [approx_crossing(parts[0]) for parts in crossings]
+                chunks = ()
+            for chunk in chunks:
+                n = len(chunk)
+                if every_crossed(args.every, kidx, n):
+                    print(f'Series {idx} ({sdesc}): writeout progress {kidx}/{total}...')
+                for quart in quarts:
+                    if kidx <= quart < kidx + n:
+                        qvals[quart] = chunk[quart - kidx]
+                if args.zc:
+                    zpt = crossing(zpt, chunk, kidx, denom, 0)
+                if args.zc_veq:
+                    zpts = [crossing(pt, chunk, kidx, denom, elem[1]) for pt, elem in zip(zpts, veqs)]
+                cpts = [crossing(pt, chunk, kidx, denom, parts[0]) for pt, parts in zip(cpts, crossings)]
+                if step is None:
+                    blk.write([2*(k/denom)-1 for k in range(kidx, kidx + n)], chunk)
+                else:
+                    end = kidx + n
+                    ks = set(range(-(-kidx // step) * step, end, step))
+                    ks.update(range(-(-(kidx + 1) // step) * step - 1, end, step))
+                    ks.update(q for q in quarts if kidx <= q < end)
+                    ks.update(pt[2] for pt in [zpt] + zpts + cpts if pt and kidx <= pt[2] < end)
+                    if end == total:
+                        ks.add(total - 1)
+                    # The sorted chunk is bisected for where the value moves on between those
+                    keep, pos = [], 0
+                    for k in sorted(ks) + [end]:
+                        while True:
+                            j = 0 if lastv is None else bisect.bisect_right(chunk, lastv + vstep, pos)
+                            if kidx + j >= k:
+                                break
+                            keep.append(kidx + j)
+                            lastv, pos = chunk[j], j + 1
+                        if k < end:
+                            keep.append(k)
+                            lastv, pos = chunk[k - kidx], k - kidx + 1
+                    written += len(keep)
+                    blk.write([2*(k/denom)-1 for k in keep], [chunk[k - kidx] for k in keep])
+                kidx += n
+            if total == 1:
+                blk.write([1], [qvals[0]])
+            blk.close()
+            dblk = DataBlock(pf, f'ser{idx}d', 2, f'#series {sdesc} points', binf, args.binary_type)
+            dblk.write([2*(quart/denom)-1 for quart in quarts], [qvals[quart] for quart in quarts])
+            dblk.close()
+            if args.approx_percentile:
+                print(f'Series {idx} ({sdesc}) done writing {written} points from a sketch of {total}')
+            elif step is None:
+                print(f'Series {idx} ({sdesc}) done writing {total} points')
+            else:
+                print(f'Series {idx} ({sdesc}) done writing {written} of {total} points')
+            effidx = idx - 1 if comparing else idx
+            style = args.quartile_pts[effidx % len(args.quartile_pts)]
+            plots.append(f'{blk.ref} using 1:2:(0) with linespoints pt {style} pi {written} ps variable lc rgb "{colors[idx-1]}" title "{titles[idx]}"')
+            plots.append(f'{dblk.ref} with points lc rgb "{colors[idx-1]}" pt {style} notitle')
+            chroff = -0.5 if idx % 2 == 0 else 0.0
+            if args.zc and zpt:
+                labels.append(f'"{100*zpt[0]:.3f}%" at {2*zpt[0]-1},{zpt[1]} tc rgb "{colors[idx-1]}" font ",6" offset character 0,{chroff} point pt 1 lc rgb "{colors[idx-1]}"')
+            if args.zc_veq and zpts:
+                for i, pt in enumerate(zpts):
+                    if not pt:
+                        continue
+                    labels.append(f'"{100*pt[0]:.3f}%" at {2*pt[0]-1},{pt[1]} tc rgb "{colors[idx-1]}" font ",6" offset character 0,{chroff} point pt 1 lc rgb "{colors[idx-1]}"')
+            if crossings:
+                for i, pt in enumerate(cpts):
+                    if not pt:
+                        continue
+                    val, lbl, col = crossings[i]
+                    labels.append(f'"{lbl},{100*pt[0]:.3f}%" at {2*pt[0]-1},{pt[1]} right tc rgb "{col}" font ",6" offset character 0,{chroff} point pt 1 lc rgb "{col}"')
+
+        for lab in labels:
+            pf.write(f'set label {lab}\n')
+        if args.veq and veqs:
+            for name, val, col in veqs:
+                plots.append(f'{val} title {name!r} lc rgbcolor "{col}"')
+        pf.write(f'plot {", ".join(plots)}\n')
+        pf.close()
+    elif args.mode == 'changeover':
+        print('Writing data files...')
+        if len(args.series) != 2:
+            print('This mode only supports two series; aborting.')
+            return
+        # Verdict thresholds from the veqs, nearest 0 first (see SqliteStore.verdicts); a sign change always counts
+        pos = sorted({val: name for name, val, col in veqs if val > 0}.items())
+        neg = sorted({val: name for name, val, col in veqs if val < 0}.items(), reverse=True)
+        def band_name(b):
+            if b == 0:
+                return '0'
+            ths = pos if b > 0 else neg
+            if abs(b) > 1:
+                return ths[abs(b) - 2][1].strip('"')
+            if ths:
+                return f'(0, {ths[0][0]})' if b > 0 else f'({ths[0][0]}, 0)'
+            return '> 0' if b > 0 else '< 0'
+
+        pf = open(args.basename + '.gp', 'w')
+        pf.write(f'''set terminal {args.terminal}
+set output "{args.basename}.{args.exten}"
+set zeroaxis
+set key right bottom font "sans,8" tc variable
+set size square
+ident(x) = x
+''')
+        for name, val, col in veqs:
+            pf.write(f'set arrow from graph 0, first {val} to graph 1, first {val} nohead lw 0.5 lt 2 lc rgb "{col}"\n')
+            pf.write(f'set arrow from {val}, graph 0 to {val}, graph 1 nohead lw 0.5 lt 2 lc rgb "{col}"\n')
+        if args.xr:
+            pf.write(f'set xrange {args.xr}\n')
+        if args.yr:
+            pf.write(f'set yrange {args.yr}\n')
+        pmapf = PRETTY_MAPS[args.map]
+        pmaps = ''
+        if pmapf:
+            pmaps = f' ({pmapf})'
+        if args.xl is None:
+            args.xl = f"LR of {titles[0]}{pmaps}"
+        if args.yl is None:
+            args.yl = f"LR of {titles[1]}{pmaps}"
         pf.write(f'set xlabel "{args.xl}"\n')
-    if args.yl is not None:
         pf.write(f'set ylabel "{args.yl}"\n')
 
-    if comparing:
-        title = f'{titles[0]} as x = 0'
+        # One pass over the join: every pair is counted, and those changing verdict are written out
+        cf = open(args.basename + '.changeover.csv', 'w', newline='')
+        cw = csv.writer(cf)
+        cw.writerow(['Case', 'Contributor', 'PrimValue', 'SeriesValue', 'From', 'To'])
+        blk = DataBlock(pf, 'changes', 3, f'# series {args.series[0]} vs {args.series[1]} changeovers', binf, args.binary_type)
+        counts = {}
+        kidx = 0
+        for chunk in store.verdicts(1, [t for t, name in pos], [t for t, name in neg]):
+            if every_crossed(args.every, kidx, len(chunk)):
+                print(f'Changeover: writeout progress {kidx}...')
+            xs, ys, dirs = [], [], []
+            for b0, b1, case, contr, v0, v1 in chunk:
+                counts[b0, b1] = counts.get((b0, b1), 0) + 1
+                if b0 != b1:
+                    cw.writerow([case, contr, v0, v1, band_name(b0), band_name(b1)])
+                    xs.append(v0)
+                    ys.append(v1)
+                    dirs.append(b1 - b0)
+            blk.write(xs, ys, dirs)
+            kidx += len(chunk)
+        blk.close()
+        cf.close()
+
+        with open(args.basename + '.changeover.counts.csv', 'w', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(['From', 'To', 'Count'])
+            for (b0, b1), n in sorted(counts.items()):
+                w.writerow([band_name(b0), band_name(b1), n])
+        up = sum(n for (b0, b1), n in counts.items() if b1 > b0)
+        down = sum(n for (b0, b1), n in counts.items() if b1 < b0)
+        flips = sum(n for (b0, b1), n in counts.items() if b0 * b1 < 0)
+        print(f'{up + down} of {kidx} keys change verdict ({up} up, {down} down, {flips} change sign)')
+
+        title = f'x = {titles[0]}, y = {titles[1]}: {up + down} of {kidx} verdicts change'
         if args.title:
             title = args.title + ': ' + title
-    else:
-        title = ''
-        if args.title:
-            title = args.title
-    if args.no_title:
-        pf.write(f'set notitle\n')
-    else:
-        pf.write(f'set title "{title}"\n')
-    plots = []
-    labels = []
-
-    print('Writing data...')
-    for idx, sdesc in enumerate(args.series):
-        if idx == 0 and comparing:
-            continue
-        kidx = 0
-        zpt = None
-        zpts = [None for i in veqs]
-        if comparing:
-            cur.execute('SELECT count(*) FROM series AS s1 JOIN series AS s2 USING (cnum, contr) WHERE s1.idx = 0 AND s2.idx = ?', (idx,))
+        title += quad_title
+        if args.no_title:
+            pf.write(f'set notitle\n')
         else:
-            cur.execute('SELECT count(*) FROM series WHERE idx = ?', (idx,))
-        total = cur.fetchone()[0]
-        if total == 0:
-            print('WARN: Series {idx} ({sdesc}) has no data and will not be plotted')
-            continue
-        dvar = f'ser{idx}'
-        pf.write(f'${dvar} <<EOD\n')
-        pf.write(f'# series {sdesc} percentile\n')
-        write_twice = total == 1
-        saw_neg = None
-        saw_negs = [None for i in veqs]
-        crossings = series_crossings.get(idx, [])
-        c_negs = [None for i in crossings]
-        cpts = [None for i in crossings]
-        for row in cur.execute(
-                'SELECT s2.value - s1.value FROM series AS s1 JOIN series AS s2 USING (cnum, contr) WHERE s1.idx = 0 AND s2.idx = ? ORDER BY (s2.value - s1.value)'
-                if comparing else
-                'SELECT value FROM series WHERE idx = ? ORDER BY value', (idx,)):
-            if args.every is not None and kidx % args.every == 0:
-                print(f'Series {idx} ({sdesc}): writeout progress {kidx}/{total}...')
-            pf.write(f'{2*(kidx/(total-1))-1}\t{row[0]}\n')
-            if write_twice:
-                df.write(f'1\t{row[0]}\n')
-                break
-            if args.zc:
-                if saw_neg is False and row[0] >= 0:
-                    zpt = (kidx/(total-1), row[0])
-                saw_neg = row[0] >= 0
-            if args.zc_veq:
-                for i, elem in enumerate(veqs):
-                    val = elem[1]
-                    if saw_negs[i] is False and (row[0]-val) >= 0:
-                        zpts[i] = (kidx/(total-1), row[0])
-                    saw_negs[i] = (row[0]-val) >= 0
-            if crossings:
-                for i, parts in enumerate(crossings):
-                    val = parts[0]
-                    if c_negs[i] is False and row[0] >= val:
-                        cpts[i] = (kidx/(total-1), row[0])
-                    c_negs[i] = row[0] >= val
-            kidx += 1
-        pf.write('EOD\n')
-        ddvar = f'ser{idx}d'
-        pf.write(f'${ddvar} <<EOD\n')
-        pf.write(f'#series {sdesc} points\n')
-        for quart in (0, total // 4, total // 2, 3 * total // 4, total - 1):
-            cur.execute(
-                'SELECT s2.value - s1.value FROM series AS s1 JOIN series AS s2 USING (cnum, contr) WHERE s1.idx = 0 AND s2.idx = ? ORDER BY (s2.value - s1.value) LIMIT 1 OFFSET ?'
-                if comparing else
-                'SELECT value FROM series WHERE idx = ? ORDER BY value LIMIT 1 OFFSET ?', (idx, quart))
-            pf.write(f'{2*(quart/(total-1))-1}\t{cur.fetchone()[0]}\n')
-        pf.write('EOD\n')
-        print(f'Series {idx} ({sdesc}) done writing {total} points')
-        effidx = idx - 1 if comparing else idx
-        style = args.quartile_pts[effidx % len(args.quartile_pts)]
-        plots.append(f'${dvar} using 1:2:(0) with linespoints pt {style} pi {total} ps variable lc rgb "{colors[idx-1]}" title "{titles[idx]}"')
-        plots.append(f'${ddvar} with points lc rgb "{colors[idx-1]}" pt {style} notitle')
-        chroff = -0.5 if idx % 2 == 0 else 0.0
-        if args.zc and zpt is not None:
-            labels.append(f'"{100*zpt[0]:.3f}%" at {2*zpt[0]-1},{zpt[1]} tc rgb "{colors[idx-1]}" font ",6" offset character 0,{chroff} point pt 1 lc rgb "{colors[idx-1]}"')
-        if args.zc_veq and zpts:
-            for i, pt in enumerate(zpts):
-                if pt is None:
-                    continue
-                labels.append(f'"{100*pt[0]:.3f}%" at {2*pt[0]-1},{pt[1]} tc rgb "{colors[idx-1]}" font ",6" offset character 0,{chroff} point pt 1 lc rgb "{colors[idx-1]}"')
-        if crossings:
-            for i, pt in enumerate(cpts):
-                if pt is None:
+            pf.write(f'set title "{title}"\n')
+        plots = [
+            f'{blk.ref} using 1:($3 > 0 ? $2 : 1/0) with points lw {args.dot_size} pt {args.pts[0 % len(args.pts)]} lc rgb "{colors[0]}" title "up ({up})"',
+            f'{blk.ref} using 1:($3 < 0 ? $2 : 1/0) with points lw {args.dot_size} pt {args.pts[1 % len(args.pts)]} lc rgb "{colors[1]}" title "down ({down})"',
+            'ident(x) with lines lc rgb "#77000000" lw 1 title "y=x"',
+        ]
+        pf.write(f'plot {", ".join(plots)}\n')
+        pf.close()
+    elif args.mode == 'density':
+        # Counts are binned by the store, so the output only grows with the number of bins
+        nx, _, ny = args.bins.partition(',')
+        nx = int(nx)
+        ny = int(ny) if ny else nx
+        bounds = [store.bounds(idx) for idx in range(len(args.series))]
+        if any(b[0] is None for b in bounds):
+            print('WARN: some series have no data and will not be plotted')
+        oned = args.density_1d
+        if not oned and (bounds[0][0] is None or all(b[0] is None for b in bounds[1:])):
+            print('WARN: density against the primary series needs it and another series with data; histogramming each series on its own instead')
+            oned = True
+        pf = open(args.basename + '.gp', 'w')
+        pf.write(f'''set terminal {args.terminal}
+set output "{args.basename}.{args.exten}"
+set key right top font "sans,8" tc variable
+''')
+        pmapf = PRETTY_MAPS[args.map]
+        pmaps = ''
+        if pmapf:
+            pmaps = f' ({pmapf})'
+        title = args.title or ''
+        title += quad_title
+        if args.no_title:
+            pf.write(f'set notitle\n')
+        else:
+            pf.write(f'set title "{title}"\n')
+
+        if oned:
+            xbins = bins_over(args.xr, bounds, nx)
+            lo, hi, n = xbins
+            width = (hi - lo) / n
+            pf.write(f'set xrange [{lo}:{hi}]\n')
+            if args.yr:
+                pf.write(f'set yrange {args.yr}\n')
+            if args.xl is None:
+                args.xl = f'LR{pmaps}'
+            if args.yl is None:
+                args.yl = 'Fraction of keys'
+            pf.write(f'set xlabel "{args.xl}"\nset ylabel "{args.yl}"\n')
+            if args.veq:
+                for name, val, col in veqs:
+                    pf.write(f'set arrow from {val}, graph 0 to {val}, graph 1 nohead lw 0.5 lt 2 lc rgb "{col}"\n')
+            plots = []
+            for idx, sdesc in enumerate(args.series):
+                if bounds[idx][0] is None:
                     continue
-                val, lbl, col = crossings[i]
-                labels.append(f'"{lbl},{100*pt[0]:.3f}%" at {2*pt[0]-1},{pt[1]} right tc rgb "{col}" font ",6" offset character 0,{chroff} point pt 1 lc rgb "{col}"')
+                counts = store.histogram(idx, xbins)
+                total = store.count(idx)
+                blk = DataBlock(pf, f'den{idx}', 2, f'# series {sdesc} density, {n} bins', binf, args.binary_type)
+                blk.write([lo + (i + 0.5) * width for i in range(n)], [c / total for c in counts])
+                blk.close()
+                plots.append(f'{blk.ref} with histeps lw {args.dot_size} lc rgb "{colors[idx]}" title "{titles[idx]}"')
+                print(f'Series {idx} ({sdesc}) binned {sum(counts)} of {total} values')
+            pf.write(f'plot {", ".join(plots)}\n')
+        else:
+            xbins = bins_over(args.xr, bounds[:1], nx)
+            ybins = bins_over(args.yr, bounds[1:], ny)
+            (xlo, xhi, nx), (ylo, yhi, ny) = xbins, ybins
+            xw, yw = (xhi - xlo) / nx, (yhi - ylo) / ny
+            pf.write(f'set xrange [{xlo}:{xhi}]\nset yrange [{ylo}:{yhi}]\n')
+            pf.write('set size square\nset cblabel "Keys"\n')
+            if args.density_log:
+                pf.write('set logscale cb\n')
+            if args.xl is None:
+                args.xl = f"LR of {titles[0]}{pmaps}"
+            if args.yl is None:
+                args.yl = f"LR{pmaps}"
+            pf.write(f'set xlabel "{args.xl}"\nset ylabel "{args.yl}"\n')
+            if args.veq:
+                for name, val, col in veqs:
+                    pf.write(f'set arrow from graph 0, first {val} to graph 1, first {val} nohead front lw 0.5 lt 2 lc rgb "{col}"\n')
+                    pf.write(f'set arrow from {val}, graph 0 to {val}, graph 1 nohead front lw 0.5 lt 2 lc rgb "{col}"\n')
+            panels = [idx for idx in range(1, len(args.series)) if bounds[idx][0] is not None]
+            if len(panels) > 1:
+                pf.write(f'set multiplot layout 1,{len(panels)}\n')
+            for idx in panels:
+                sdesc = args.series[idx]
+                counts = store.histogram(idx, xbins, ybins)
+                # A matrix of ny rows by nx columns; empty bins are left undefined, so they aren't drawn
+                pf.write(f'$den{idx} <<EOD\n')
+                for by in range(ny):
+                    pf.write(' '.join(str(counts[bx * ny + by]) if counts[bx * ny + by] else 'NaN' for bx in range(nx)) + '\n')
+                pf.write('EOD\n')
+                if len(panels) > 1:
+                    pf.write(f'set title "{titles[idx]}"\n')
+                pf.write(f'plot $den{idx} matrix using ({xlo}+($1+0.5)*{xw}):({ylo}+($2+0.5)*{yw}):3 with image title "{titles[idx]}", x with lines lc rgb "#77000000" lw 1 title "y=x"\n')
+                print(f'Series {idx} ({sdesc}) binned {sum(counts)} pairs')
+            if len(panels) > 1:
+                pf.write('unset multiplot\n')
+        pf.close()
+    else:
+        raise ValueError('Unknown plot mode')
+    if binf is not None:
+        binf.close()
+
+def load_manifest(path):
+    '''Parsed arguments of each figure in a manifest; see --help-manifest.'''
+    if path.endswith('.toml'):
+        if tomllib is None:
+            print('TOML manifests need Python 3.11 or later', file=sys.stderr)
+            exit(1)
+        with open(path, 'rb') as f:
+            man = tomllib.load(f)
+    else:
+        with open(path) as f:
+            man = json.load(f)
+    common = [str(a) for a in man.get('args', [])]
+    figures = []
+    for i, fig in enumerate(man['figures']):
+        fargs = parser.parse_args(common + [str(a) for a in fig])
+        if fargs.basename is None:
+            parser.error(f'figure {i} of {path} has no basename')
+        figures.append(fargs)
+    return figures
+
+def render_figure(i):
+    '''Render figures[i] in a worker forked once the store was sealed; returns its --profile records.'''
+    store.reconnect()
+    n = len(prof.records)
+    render_profiled(figures[i], views[i])
+    return prof.records[n:]
+
+def render_profiled(fargs, view):
+    with prof.phase('render', fargs.basename) as rec:
+        render(fargs, view)
+    if args.profile:
+        rec['rows'] = sum(view.count(idx) for idx in range(len(fargs.series)))
+
+if args.profile_json:
+    args.profile = True
+prof = lrprofile.Profile()
+
+figures = load_manifest(args.manifest) if args.manifest else [args]
 
-    for lab in labels:
-        pf.write(f'set label {lab}\n')
-    if args.veq and veqs:
-        for name, val, col in veqs:
-            plots.append(f'{val} title {name!r} lc rgbcolor "{col}"')
-    pf.write(f'plot {", ".join(plots)}\n')
-    pf.close()
-elif args.mode == 'changeover':
-    print('Writing data files...')
-    if len(args.series) != 2:
-        print('This mode only supports two series; aborting.')
-        exit()
-    raise NotImplementedError()
+print('Reading series...', file=sys.stderr)
+if args.store == 'sqlite':
+    backing = args.backing
+    if not backing and len(figures) > 1 and args.jobs > 1:
+        # Figures are rendered in forked workers, which each need their own connection
+        tmp = tempfile.NamedTemporaryFile(suffix='.sqlite')
+        backing = tmp.name
+    store = lrstore.SqliteStore(backing if backing else ':memory:')
+else:
+    if args.backing:
+        print('--backing only applies to the sqlite store', file=sys.stderr)
+        exit(1)
+    try:
+        store = lrstore.STORES[args.store]()
+    except RuntimeError as e:
+        print(f'Can\'t use store {args.store}: {e}', file=sys.stderr)
+        exit(1)
+
+if args.profile:
+    store.trace(prof.count)
+
+# Each distinct series is read and ingested once, however many figures use it
+shared, todo, views = {}, [], []
+sketches = {}  # (sid, k) -> KLL of the series, for --approx-percentile without comparing
+for fargs in figures:
+    sids = []
+    for sdesc, opts in series_plan(fargs):
+        fn, conds, title = lrseries.parse_spec(sdesc)
+        key = (fn, tuple(conds), opts, fargs.no_drop, fargs.no_sanity)
+        if key not in shared:
+            shared[key] = len(shared)
+            todo.append((shared[key], sdesc, opts, fargs))
+        sids.append(shared[key])
+    if fargs.approx_percentile and fargs.mode == 'percentile-nocmp':
+        for sid in sids:
+            sketches.setdefault((sid, fargs.approx_k), lrsketch.KLL(fargs.approx_k))
+    views.append(lrstore.StoreView(store, sids, sketches))
+
+# Workers only parse and filter; aggregation, mapping and the store (and cache) all happen here, in series order
+cache = lrseries.SeriesCache(args.cache) if args.cache else None
+readahead = lrseries.ReadAhead(args.jobs) if args.jobs > 1 else None
+# Series differing only in --races, --agg or --map share one read of their file, each reducing the raw rows its own way
+reads = {}
+for sid, sdesc, opts, fargs in todo:
+    fn, conds, title = lrseries.parse_spec(sdesc)
+    reads.setdefault((fn, tuple(conds)), []).append(sid)
+sources, cached, reader = [None] * len(todo), [False] * len(todo), {}
+for sids in reads.values():
+    sid, sdesc, opts, fargs = todo[sids[0]]
+    races = list(dict.fromkeys(r for ssid in sids for r in todo[ssid][2][0]))
+    a = (sid, sdesc, races)
+    k = {'every': fargs.every}
+    hit = None
+    if cache is not None:
+        ident, stamp = cache.key(sdesc)
+        hit = cache.get(ident, stamp, races)
+    if hit is not None:
+        src = hit
+    else:
+        src = readahead.add(*a, **k) if readahead else lrseries.read_series(*a, **k)
+        if cache is not None:
+            src = cache.put(ident, stamp, races, src)
+    # Later series replay what the first buffered as it read
+    for ssid, ssrc in zip(sids, itertools.tee(src, len(sids)) if len(sids) > 1 else [src]):
+        sources[ssid], cached[ssid], reader[ssid] = ssrc, hit is not None, sid
+
+for sid, sdesc, opts, fargs in todo:
+    for col, op, val in lrseries.parse_spec(sdesc)[1]:
+        print(f'Series {sid}: {sdesc}: condition {col} {op} {val}')
+    if reader[sid] != sid:
+        print(f'Series {sid} ({sdesc}): reusing rows read for series {reader[sid]}')
+    elif cached[sid]:
+        print(f'Series {sid} ({sdesc}): reusing cached rows')
+    with prof.phase('ingest', sdesc) as rec:
+        src = prof.reading(sources[sid], rec) if reader[sid] == sid else sources[sid]
+        drops, dups = ingest(store, sid, sdesc, src, opts, fargs, [sk for (ssid, k), sk in sketches.items() if ssid == sid])
+    if args.profile:
+        rec['rows'] = store.count(sid)
+    print(f'Series {sid} ({sdesc}) imported with {drops} drops')
+    for key, n in dups:
+        for i in range(n):
+            print(f'WARN: dup key {key} in series {sdesc}!', file=sys.stderr)
+with prof.phase('seal'):
+    store.seal()
+
+for fargs, view in zip(figures, views):
+    if fargs.mode == 'density' and not any(view.count(idx) for idx in range(len(fargs.series))):
+        parser.error(f'density mode needs data, but no series of {fargs.basename} has any')
+
+if len(figures) > 1 and args.jobs > 1:
+    # Forked, so the workers start out with the sealed store (and figures and views) as they are here
+    rpool = multiprocessing.get_context('fork').Pool(args.jobs)
+    for res in [rpool.apply_async(render_figure, (i,)) for i in range(len(figures))]:
+        prof.records.extend(res.get())
+    rpool.close()
 else:
-    raise ValueError('Unknown plot mode')
-
-if args.quads:
-    QUADS = {
-        1: ('>', '>'),
-        2: ('<', '>'),
-        3: ('<', '<'),
-        4: ('>', '<'),
-    }
-
-    print('Writing quadrants...')
-
-    for sidx in range(1, len(args.series)):
-        for quad, ops in QUADS.items():
-            print(f'Series {sidx} ({args.series[sidx]}) quadrant {quad}')
-            s1o, s2o = ops
-            f = open(f'{args.basename}.ser{sidx}.quad{quad}.csv', 'w')
-            f.write('Case,Contributor,PrimValue,SeriesValue\n')
-            for case, contr, s1v, s2v in cur.execute(f'SELECT s1.cnum, s1.contr, s1.value, s2.value FROM series AS s1 JOIN series AS s2 USING (cnum, contr) WHERE s1.idx=0 AND s2.idx=? AND s1.value{s1o}0 AND s2.value{s2o}0', (sidx,)):
-                f.write(f'{case},{contr},{s1v},{s2v}\n')
-            f.close()
+    for fargs, view in zip(figures, views):
+        render_profiled(fargs, view)
+
+if args.profile:
+    prof.finish()
+    prof.table()
+    if args.profile_json:
+        prof.dump(args.profile_json)
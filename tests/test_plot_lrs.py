@@ -0,0 +1,61 @@
+import os, subprocess, sys, random
+
+PLOT_LRS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'plot_lrs.py')
+HEADER = 'Case,Contributor,Dropout,Black,Hispanic,Caucasian,Asian\n'
+
+def write_series(path, n, seed=0):
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write(HEADER)
+        for i in range(n):
+            vals = ','.join(str(10 ** rng.gauss(0, 3)) for r in range(4))
+            f.write(f'{i},D{i}-0,NONE,{vals}\n')
+    return str(path)
+
+def run(tmp_path, *args):
+    return subprocess.run([sys.executable, PLOT_LRS, *args, str(tmp_path / 'out')], cwd=tmp_path, capture_output=True, text=True)
+
+def test_density_single_series(tmp_path):
+    a = write_series(tmp_path / 'a.csv', 200)
+    res = run(tmp_path, '-s', a, '--mode', 'density')
+    assert res.returncode == 0, res.stderr
+    assert 'with histeps' in (tmp_path / 'out.gp').read_text()
+
+def test_density_empty_primary(tmp_path):
+    a = write_series(tmp_path / 'a.csv', 0)
+    b = write_series(tmp_path / 'b.csv', 200)
+    res = run(tmp_path, '-s', a, '-s', b, '--mode', 'density')
+    assert res.returncode == 0, res.stderr
+    assert 'with histeps' in (tmp_path / 'out.gp').read_text()
+
+def test_density_all_empty(tmp_path):
+    a = write_series(tmp_path / 'a.csv', 0)
+    for extra in ([], ['--density-1d']):
+        res = run(tmp_path, '-s', a, '-s', a, '--mode', 'density', *extra)
+        assert res.returncode == 2
+        assert 'no series of' in res.stderr
+        assert 'Traceback' not in res.stderr
+
+def curve_points(gp):
+    '''Data lines of each percentile curve heredoc in a .gp file.'''
+    curves, cur = {}, None
+    for line in gp.splitlines():
+        if line.startswith('$ser') and line.endswith('<<EOD') and not line.split()[0].endswith('d'):
+            cur = curves[line.split()[0]] = []
+        elif line == 'EOD':
+            cur = None
+        elif cur is not None and not line.startswith('#'):
+            cur.append(line)
+    return curves
+
+def test_max_points_is_a_cap(tmp_path):
+    a = write_series(tmp_path / 'a.csv', 5000, 1)
+    b = write_series(tmp_path / 'b.csv', 5000, 2)
+    for n in (20, 100, 500):
+        for extra in (['--mode', 'percentile', '-s', b], ['--mode', 'percentile-nocmp', '-s', b], ['--mode', 'percentile-nocmp', '--approx-percentile']):
+            res = run(tmp_path, '-s', a, *extra, '--max-points', str(n), '--zc')
+            assert res.returncode == 0, res.stderr
+            curves = curve_points((tmp_path / 'out.gp').read_text())
+            assert curves
+            for name, pts in curves.items():
+                assert 0 < len(pts) <= n, (n, extra, name, len(pts))